@@ -0,0 +1,30 @@
+"""Store HTTP validators of tracefiles
+
+Revision ID: 0d8542a1b79c
+Revises: 017e0e81cb5c
+Create Date: 2026-10-18 11:20:13.412903
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0d8542a1b79c'
+down_revision = '017e0e81cb5c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TABLES = ('mastertrace', 'sitetrace', 'sitealiasmastertrace')
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('http_etag', sa.String(), nullable=True))
+        op.add_column(table, sa.Column('http_last_modified', sa.String(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, 'http_last_modified')
+        op.drop_column(table, 'http_etag')
@@ -0,0 +1,35 @@
+"""Add siteskip table
+
+Revision ID: 7c2f4e91d3a0
+Revises: 0d8542a1b79c
+Create Date: 2026-10-18 12:02:47.118320
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2f4e91d3a0'
+down_revision = '0d8542a1b79c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('siteskip',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=False),
+    sa.Column('checkrun_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['checkrun_id'], ['checkrun.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_siteskip_checkrun_id'), 'siteskip', ['checkrun_id'], unique=False)
+    op.create_index(op.f('ix_siteskip_site_id'), 'siteskip', ['site_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_siteskip_site_id'), table_name='siteskip')
+    op.drop_index(op.f('ix_siteskip_checkrun_id'), table_name='siteskip')
+    op.drop_table('siteskip')
@@ -0,0 +1,58 @@
+"""Store trace contents once in traceblob, keyed by their sha256
+
+Revision ID: a4f1c3e8b2d6
+Revises: b3c8f2d4a6e1
+Create Date: 2026-10-18 13:05:31.640219
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4f1c3e8b2d6'
+down_revision = 'b3c8f2d4a6e1'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TABLES = ('mastertrace', 'sitetrace', 'sitealiasmastertrace')
+
+def upgrade():
+    op.create_table('traceblob',
+    sa.Column('digest', sa.String(), nullable=False),
+    sa.Column('full', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('digest')
+    )
+    for table in TABLES:
+        op.add_column(table, sa.Column('full_digest', sa.String(), nullable=True))
+        op.execute("""
+            INSERT INTO traceblob (digest, "full")
+            SELECT DISTINCT encode(digest("full", 'sha256'), 'hex'), "full"
+            FROM %(table)s
+            WHERE "full" IS NOT NULL
+            ON CONFLICT DO NOTHING
+            """ % {'table': table})
+        op.execute("""
+            UPDATE %(table)s
+            SET full_digest = encode(digest("full", 'sha256'), 'hex')
+            WHERE "full" IS NOT NULL
+            """ % {'table': table})
+        op.create_foreign_key(op.f('fk_%s_full_digest_traceblob'%(table,)), table, 'traceblob', ['full_digest'], ['digest'])
+        op.create_index(op.f('ix_%s_full_digest'%(table,)), table, ['full_digest'], unique=False)
+        op.drop_column(table, 'full')
+
+
+def downgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('full', sa.String(), nullable=True))
+        op.execute("""
+            UPDATE %(table)s
+            SET "full" = traceblob."full"
+            FROM traceblob
+            WHERE %(table)s.full_digest = traceblob.digest
+            """ % {'table': table})
+        op.drop_index(op.f('ix_%s_full_digest'%(table,)), table_name=table)
+        op.drop_constraint(op.f('fk_%s_full_digest_traceblob'%(table,)), table, type_='foreignkey')
+        op.drop_column(table, 'full_digest')
+    op.drop_table('traceblob')
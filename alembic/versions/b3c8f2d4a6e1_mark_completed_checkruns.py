@@ -0,0 +1,26 @@
+"""Mark completed checkruns
+
+Revision ID: b3c8f2d4a6e1
+Revises: 7c2f4e91d3a0
+Create Date: 2026-10-18 12:41:08.257903
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b3c8f2d4a6e1'
+down_revision = '7c2f4e91d3a0'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('checkrun', sa.Column('completed', sa.Boolean(), server_default=sa.false(), nullable=False))
+    # we cannot tell which of the existing ones were cut short
+    op.execute("UPDATE checkrun SET completed = TRUE")
+
+
+def downgrade():
+    op.drop_column('checkrun', 'completed')
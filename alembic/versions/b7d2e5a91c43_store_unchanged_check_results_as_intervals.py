@@ -0,0 +1,78 @@
+"""Store unchanged check results as intervals of checkruns
+
+Revision ID: b7d2e5a91c43
+Revises: a4f1c3e8b2d6
+Create Date: 2026-10-18 14:10:52.907116
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e5a91c43'
+down_revision = 'a4f1c3e8b2d6'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# table -> the columns its compatibility view shows, besides id and checkrun_id
+COLUMNS = {
+    'mastertrace': ('site_id', 'full_digest', 'trace_timestamp', 'error', 'content', 'http_etag', 'http_last_modified'),
+    'sitetrace': ('site_id', 'archive_update_in_progress', 'archive_update_required',
+                  'full_digest', 'trace_timestamp', 'error', 'content', 'http_etag', 'http_last_modified'),
+    'traceset': ('site_id', 'traceset', 'error'),
+    'sitealiasmastertrace': ('sitealias_id', 'full_digest', 'trace_timestamp', 'error', 'content', 'http_etag', 'http_last_modified'),
+}
+
+def create_view(table, columns):
+    """Create <table>_run, which has one row per checkrun like <table> used to.
+    """
+    op.execute("""
+        CREATE VIEW %(table)s_run AS
+            SELECT id, checkrun_id, %(columns)s
+            FROM %(table)s
+            WHERE checkrun_id = last_checkrun_id
+          UNION ALL
+            SELECT span.id, checkrun.id AS checkrun_id, %(span_columns)s
+            FROM %(table)s AS span JOIN
+                checkrun AS first_checkrun ON first_checkrun.id = span.checkrun_id JOIN
+                checkrun AS last_checkrun  ON last_checkrun.id  = span.last_checkrun_id JOIN
+                checkrun ON checkrun.timestamp BETWEEN first_checkrun.timestamp AND last_checkrun.timestamp
+            WHERE span.checkrun_id <> span.last_checkrun_id
+        """ % {
+            'table': table,
+            'columns': ', '.join(columns),
+            'span_columns': ', '.join('span.'+c for c in columns),
+        })
+
+def upgrade():
+    for table, columns in COLUMNS.items():
+        op.add_column(table, sa.Column('last_checkrun_id', sa.Integer(), nullable=True))
+        op.execute("UPDATE %(table)s SET last_checkrun_id = checkrun_id" % {'table': table})
+        op.alter_column(table, 'last_checkrun_id', nullable=False)
+        op.create_foreign_key(op.f('fk_%s_last_checkrun_id_checkrun'%(table,)), table, 'checkrun', ['last_checkrun_id'], ['id'], ondelete='CASCADE')
+        op.create_index(op.f('ix_%s_last_checkrun_id'%(table,)), table, ['last_checkrun_id'], unique=False)
+        create_view(table, columns)
+
+
+def downgrade():
+    for table, columns in COLUMNS.items():
+        op.execute("DROP VIEW %(table)s_run" % {'table': table})
+        # expand intervals back into one row per checkrun
+        op.execute("""
+            INSERT INTO %(table)s (checkrun_id, last_checkrun_id, %(columns)s)
+            SELECT checkrun.id, checkrun.id, %(span_columns)s
+            FROM %(table)s AS span JOIN
+                checkrun AS first_checkrun ON first_checkrun.id = span.checkrun_id JOIN
+                checkrun AS last_checkrun  ON last_checkrun.id  = span.last_checkrun_id JOIN
+                checkrun ON checkrun.timestamp >  first_checkrun.timestamp AND
+                            checkrun.timestamp <= last_checkrun.timestamp
+            """ % {
+                'table': table,
+                'columns': ', '.join(columns),
+                'span_columns': ', '.join('span.'+c for c in columns),
+            })
+        op.drop_index(op.f('ix_%s_last_checkrun_id'%(table,)), table_name=table)
+        op.drop_constraint(op.f('fk_%s_last_checkrun_id_checkrun'%(table,)), table, type_='foreignkey')
+        op.drop_column(table, 'last_checkrun_id')
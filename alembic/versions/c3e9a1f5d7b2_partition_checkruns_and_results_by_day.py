@@ -0,0 +1,153 @@
+"""Partition checkrun and the check results by day
+
+Revision ID: c3e9a1f5d7b2
+Revises: b7d2e5a91c43
+Create Date: 2026-10-18 16:02:14.385120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3e9a1f5d7b2'
+down_revision = 'b7d2e5a91c43'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+import datetime
+
+
+# tables holding results of a checkrun, in addition to checkrun itself
+CHILD_TABLES = ('mastertrace', 'sitetrace', 'traceset', 'sitealiasmastertrace', 'checkoverview', 'siteskip')
+
+# table -> the columns its compatibility view shows, besides id, checkrun_id and checkrun_timestamp
+COLUMNS = {
+    'mastertrace': ('site_id', 'full_digest', 'trace_timestamp', 'error', 'content', 'http_etag', 'http_last_modified'),
+    'sitetrace': ('site_id', 'archive_update_in_progress', 'archive_update_required',
+                  'full_digest', 'trace_timestamp', 'error', 'content', 'http_etag', 'http_last_modified'),
+    'traceset': ('site_id', 'traceset', 'error'),
+    'sitealiasmastertrace': ('sitealias_id', 'full_digest', 'trace_timestamp', 'error', 'content', 'http_etag', 'http_last_modified'),
+}
+
+def create_view(table, columns, partitioned):
+    """Create <table>_run, which has one row per checkrun.
+
+    The partitioned layout also shows the checkrun's timestamp, so that
+    filtering on it can skip partitions.
+    """
+    op.execute("""
+        CREATE VIEW %(table)s_run AS
+            SELECT id, checkrun_id, %(timestamp)s%(columns)s
+            FROM %(table)s
+            WHERE checkrun_id = last_checkrun_id
+          UNION ALL
+            SELECT span.id, checkrun.id AS checkrun_id, %(span_timestamp)s%(span_columns)s
+            FROM %(table)s AS span JOIN
+                checkrun AS first_checkrun ON first_checkrun.id = span.checkrun_id JOIN
+                checkrun AS last_checkrun  ON last_checkrun.id  = span.last_checkrun_id JOIN
+                checkrun ON checkrun.timestamp BETWEEN first_checkrun.timestamp AND last_checkrun.timestamp
+            WHERE span.checkrun_id <> span.last_checkrun_id
+        """ % {
+            'table': table,
+            'timestamp': 'checkrun_timestamp, ' if partitioned else '',
+            'span_timestamp': 'checkrun.timestamp AS checkrun_timestamp, ' if partitioned else '',
+            'columns': ', '.join(columns),
+            'span_columns': ', '.join('span.'+c for c in columns),
+        })
+
+def create_partition(table, day):
+    """Create the partition of table for day, a naive datetime in UTC.
+    """
+    op.execute("""
+        CREATE TABLE %(table)s_p%(name)s PARTITION OF %(table)s
+        FOR VALUES FROM ('%(start)s+00') TO ('%(end)s+00')
+        """ % {
+            'table': table,
+            'name': day.strftime('%Y%m%d'),
+            'start': day.isoformat(' '),
+            'end': (day + datetime.timedelta(days=1)).isoformat(' '),
+        })
+
+def rebuild(table, primary_key, partition_key=None, days=()):
+    """Replace table by a copy that is partitioned by day on partition_key, with partitions for days, or not partitioned.
+
+    Indexes and foreign keys are carried over.
+    """
+    conn = op.get_bind()
+    indexes = [indexdef.replace(' ON ONLY ', ' ON ') for (indexdef,) in conn.execute(sa.text("""
+        SELECT indexdef FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = :table AND indexname <> :pkey
+        """), {'table': table, 'pkey': table+'_pkey'})]
+    foreign_keys = conn.execute(sa.text("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'
+        """), {'table': table}).fetchall()
+
+    op.rename_table(table, table+'_old')
+    op.execute("CREATE TABLE %(table)s (LIKE %(table)s_old INCLUDING DEFAULTS) %(partition_by)s" % {
+        'table': table,
+        'partition_by': 'PARTITION BY RANGE (%s)'%(partition_key,) if partition_key is not None else '',
+    })
+    op.execute("ALTER SEQUENCE %(table)s_id_seq OWNED BY %(table)s.id" % {'table': table})
+    for day in days:
+        create_partition(table, day)
+    op.execute("INSERT INTO %(table)s SELECT * FROM %(table)s_old" % {'table': table})
+    op.execute("DROP TABLE %(table)s_old" % {'table': table})
+
+    op.create_primary_key(table+'_pkey', table, primary_key)
+    for indexdef in indexes:
+        op.execute(indexdef)
+    for (name, definition) in foreign_keys:
+        op.execute("ALTER TABLE %s ADD CONSTRAINT %s %s" % (table, name, definition))
+
+
+def upgrade():
+    for table in COLUMNS:
+        op.execute("DROP VIEW %(table)s_run" % {'table': table})
+    # a foreign key would need the timestamp too, and dropping a day's
+    # partitions replaces ON DELETE CASCADE anyway
+    for table in CHILD_TABLES:
+        op.drop_constraint('%s_checkrun_id_fkey'%(table,), table, type_='foreignkey')
+        if table in COLUMNS:
+            op.drop_constraint(op.f('fk_%s_last_checkrun_id_checkrun'%(table,)), table, type_='foreignkey')
+
+    op.alter_column('checkrun', 'timestamp', nullable=False)
+    for table in CHILD_TABLES:
+        op.add_column(table, sa.Column('checkrun_timestamp', sa.DateTime(timezone=True), nullable=True))
+        op.execute("""
+            UPDATE %(table)s
+            SET checkrun_timestamp = checkrun.timestamp
+            FROM checkrun
+            WHERE checkrun.id = %(table)s.checkrun_id
+            """ % {'table': table})
+        op.alter_column(table, 'checkrun_timestamp', nullable=False)
+
+    # every table gets a partition for every day with checkruns, and for today
+    days = [day for (day,) in op.get_bind().execute(sa.text("""
+        SELECT date_trunc('day', timestamp AT TIME ZONE 'UTC') FROM checkrun
+      UNION
+        SELECT date_trunc('day', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+        """))]
+    rebuild('checkrun', ['id', 'timestamp'], 'timestamp', days)
+    for table in CHILD_TABLES:
+        rebuild(table, ['id', 'checkrun_timestamp'], 'checkrun_timestamp', days)
+
+    for table, columns in COLUMNS.items():
+        create_view(table, columns, partitioned=True)
+
+
+def downgrade():
+    for table in COLUMNS:
+        op.execute("DROP VIEW %(table)s_run" % {'table': table})
+
+    rebuild('checkrun', ['id'])
+    for table in CHILD_TABLES:
+        rebuild(table, ['id'])
+        op.drop_column(table, 'checkrun_timestamp')
+        op.create_foreign_key('%s_checkrun_id_fkey'%(table,), table, 'checkrun', ['checkrun_id'], ['id'], ondelete='CASCADE')
+        if table in COLUMNS:
+            op.create_foreign_key(op.f('fk_%s_last_checkrun_id_checkrun'%(table,)), table, 'checkrun', ['last_checkrun_id'], ['id'], ondelete='CASCADE')
+    op.alter_column('checkrun', 'timestamp', nullable=True)
+
+    for table, columns in COLUMNS.items():
+        create_view(table, columns, partitioned=False)
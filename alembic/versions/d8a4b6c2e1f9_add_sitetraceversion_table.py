@@ -0,0 +1,48 @@
+"""Add sitetraceversion table
+
+Revision ID: d8a4b6c2e1f9
+Revises: c3e9a1f5d7b2
+Create Date: 2026-10-18 17:21:40.118342
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd8a4b6c2e1f9'
+down_revision = 'c3e9a1f5d7b2'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('sitetraceversion',
+    sa.Column('site_id', sa.Integer(), nullable=False),
+    sa.Column('sitetrace_trace_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('mastertrace_trace_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('site_id', 'sitetrace_trace_timestamp')
+    )
+    # what RunProcessor used to look up in the history every time
+    op.execute("""
+        INSERT INTO sitetraceversion (site_id, sitetrace_trace_timestamp, mastertrace_trace_timestamp)
+        SELECT DISTINCT ON (sitetrace.site_id, sitetrace.trace_timestamp)
+            sitetrace.site_id,
+            sitetrace.trace_timestamp,
+            mastertrace.trace_timestamp
+        FROM checkrun JOIN
+            mastertrace_run AS mastertrace ON checkrun.id = mastertrace.checkrun_id JOIN
+            sitetrace_run   AS sitetrace   ON checkrun.id = sitetrace.checkrun_id AND sitetrace.site_id = mastertrace.site_id
+        WHERE
+            sitetrace.trace_timestamp IS NOT NULL AND
+            mastertrace.trace_timestamp IS NOT NULL
+        ORDER BY
+            sitetrace.site_id,
+            sitetrace.trace_timestamp,
+            checkrun.timestamp
+        """)
+
+
+def downgrade():
+    op.drop_table('sitetraceversion')
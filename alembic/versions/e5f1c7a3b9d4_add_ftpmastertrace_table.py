@@ -0,0 +1,47 @@
+"""Add ftpmastertrace table
+
+Revision ID: e5f1c7a3b9d4
+Revises: d8a4b6c2e1f9
+Create Date: 2026-10-18 18:04:12.550917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5f1c7a3b9d4'
+down_revision = 'd8a4b6c2e1f9'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+# dmt.helpers.FTPMASTER when this revision was written
+FTPMASTER = "repo.traingle.org"
+
+
+def upgrade():
+    op.create_table('ftpmastertrace',
+    sa.Column('trace_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('first_seen', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('last_seen', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('trace_timestamp')
+    )
+    op.get_bind().execute(sa.text("""
+        INSERT INTO ftpmastertrace (trace_timestamp, first_seen, last_seen)
+        SELECT
+            mastertrace.trace_timestamp,
+            min(checkrun.timestamp),
+            max(checkrun.timestamp)
+        FROM checkrun JOIN
+            mastertrace_run AS mastertrace ON mastertrace.checkrun_id = checkrun.id JOIN
+            site ON mastertrace.site_id = site.id
+        WHERE
+            site.name = :ftpmastername AND
+            mastertrace.trace_timestamp IS NOT NULL
+        GROUP BY
+            mastertrace.trace_timestamp
+        """), {'ftpmastername': FTPMASTER})
+
+
+def downgrade():
+    op.drop_table('ftpmastertrace')
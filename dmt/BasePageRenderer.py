@@ -152,4 +152,4 @@ class BasePageRenderer:
             page.render()
         except AttributeError:
             self.template = self.tmplenv.get_template(page.template_name)
-            self.template.stream(page.context).dump(page.outfile, errors='strict')
+            helpers.write_file(page.outfile, self.template.render(page.context))
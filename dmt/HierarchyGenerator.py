@@ -167,11 +167,12 @@ def get_traceset_changes(cur, site_id, traces_last_change_cutoff):
         SELECT
             traceset.traceset,
             checkrun.timestamp
-        FROM traceset JOIN
+        FROM traceset_run AS traceset JOIN
             checkrun  ON traceset.checkrun_id = checkrun.id
         WHERE
             traceset.site_id = %(site_id)s AND
             traceset.traceset IS NOT NULL AND
+            traceset.checkrun_timestamp >= %(traces_last_change_cutoff)s AND
             checkrun.timestamp >= %(traces_last_change_cutoff)s
         ORDER BY
             checkrun.timestamp
@@ -219,7 +220,7 @@ class Generator():
         cur2 = dbh.cursor()
 
         now = datetime.datetime.now()
-        checkrun = helpers.get_latest_checkrun(cur)
+        checkrun = helpers.get_run_snapshot(dbh).checkrun
         if checkrun is None: return
         traces_last_change_cutoff = now - datetime.timedelta(hours=self.recent_hours)
 
@@ -241,11 +242,13 @@ class Generator():
 
             FROM
                 site
-                LEFT OUTER JOIN traceset ON site.id = traceset.site_id
+                LEFT OUTER JOIN traceset_run AS traceset ON site.id = traceset.site_id
                 LEFT OUTER JOIN checkoverview ON site.id = checkoverview.site_id
                 INNER JOIN checkrun ON checkrun.id = traceset.checkrun_id AND checkrun.id = checkoverview.checkrun_id
             WHERE
-                checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '%(recent_hours)s hours'
+                traceset.checkrun_timestamp      > CURRENT_TIMESTAMP - INTERVAL '%(recent_hours)s hours' AND
+                checkoverview.checkrun_timestamp > CURRENT_TIMESTAMP - INTERVAL '%(recent_hours)s hours' AND
+                checkrun.timestamp               > CURRENT_TIMESTAMP - INTERVAL '%(recent_hours)s hours'
             ORDER BY
                 site.id,
                 traceset.traceset IS NULL ASC,
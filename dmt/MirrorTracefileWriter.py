@@ -1,8 +1,8 @@
 #!/usr/bin/python3
 
 import argparse
+import json
 import os
-import hashlib
 import sys
 import errno
 
@@ -17,6 +17,19 @@ import dmt.db as db
 import dmt.helpers as helpers
 
 class Generator():
+    """Write the contents of every sitetrace to <outfile>/<xx>/<digest>.txt.
+
+    The files are named by the digest of their contents, so once written
+    they never change.  The checkruns covered so far are kept in STATEFILE,
+    and each run only looks at sitetraces stored since then, fetching the
+    contents of those not written yet through a server-side cursor.
+    Files can only become unreferenced when old checkruns are pruned, so
+    only then are all sitetraces checked to remove those.
+    """
+    STATEFILE = '.published.json'
+    # rows to fetch at a time when streaming trace contents
+    ITERSIZE = 100
+
     def __init__(self, outfile, **kwargs):
         self.outfile = outfile
 
@@ -26,29 +39,110 @@ class Generator():
             os.mkdir(outdir)
         return [self]
 
+    def _load_state(self):
+        try:
+            with open(os.path.join(self.outfile, self.STATEFILE)) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            # a broken state file just means starting over
+            pass
+        return {}
+
+    def _path(self, digest):
+        return self.outfile + '/' + digest[:2] + '/' + digest + '.txt'
+
     def prepare(self, dbh):
         cur = dbh.cursor()
+        state = self._load_state()
 
         cur.execute("""
-            SELECT sitetrace.full,  extract('epoch' from max(trace_timestamp)) AS ts FROM sitetrace WHERE sitetrace.full IS NOT NULL GROUP BY sitetrace.full
+            SELECT
+                min(timestamp) AS oldest,
+                max(timestamp) AS latest
+            FROM checkrun
+            """)
+        checkruns = cur.fetchone()
+        if checkruns['latest'] is None:
+            return
 
+        # The traces of sitetraces stored since the last run.  The last run
+        # might have seen only part of its latest checkrun, so that one is
+        # looked at again.
+        cur.execute("""
+            SELECT
+                full_digest AS digest,
+                extract('epoch' from max(trace_timestamp)) AS ts
+            FROM sitetrace
+            WHERE
+                full_digest IS NOT NULL AND
+                checkrun_timestamp >= %(since)s
+            GROUP BY
+                full_digest
             """, {
+                'since': state.get('latest', '-infinity'),
             })
-
+        timestamps = {}
         for row in cur.fetchall():
-            full = row['full']
-            digest = hashlib.sha256(full.encode('utf-8')).hexdigest()
-            dstdir = self.outfile+'/'+digest[:2]
-            try:
-                os.mkdir(dstdir)
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-            dstfile = dstdir + '/' + digest + '.txt'
-            with open(dstfile, "w", encoding='utf-8') as f:
-                f.write(full)
-            if row['ts'] is not None:
-                os.utime(dstfile, (row['ts'], row['ts']))
+            if not os.path.exists(self._path(row['digest'])):
+                timestamps[row['digest']] = row['ts']
+
+        if len(timestamps) > 0:
+            blobs = dbh.cursor(name='mirror_traces')
+            blobs.itersize = self.ITERSIZE
+            blobs.execute("""
+                SELECT
+                    digest,
+                    "full"
+                FROM traceblob
+                WHERE
+                    digest = ANY(%(digests)s)
+                """, {
+                    'digests': sorted(timestamps),
+                })
+            for row in blobs:
+                dstfile = self._path(row['digest'])
+                try:
+                    os.mkdir(os.path.dirname(dstfile))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                helpers.write_file(dstfile, row['full'])
+                ts = timestamps[row['digest']]
+                if ts is not None:
+                    os.utime(dstfile, (float(ts), float(ts)))
+            blobs.close()
+
+        if state.get('oldest') != checkruns['oldest'].isoformat():
+            self._remove_unreferenced(cur)
+
+        helpers.write_file(os.path.join(self.outfile, self.STATEFILE), json.dumps({
+            'oldest': checkruns['oldest'].isoformat(),
+            'latest': checkruns['latest'].isoformat(),
+        }))
+
+    def _remove_unreferenced(self, cur):
+        """Remove the files of traces no sitetrace refers to any longer
+        """
+        cur.execute("""
+            SELECT DISTINCT full_digest AS digest
+            FROM sitetrace
+            WHERE
+                full_digest IS NOT NULL
+            """)
+        wanted = set(self._path(row['digest']) for row in cur.fetchall())
+
+        for dstdir in os.listdir(self.outfile):
+            if not os.path.isdir(self.outfile+'/'+dstdir):
+                continue
+            for name in os.listdir(self.outfile+'/'+dstdir):
+                dstfile = self.outfile + '/' + dstdir + '/' + name
+                if dstfile not in wanted:
+                    os.unlink(dstfile)
+            if len(os.listdir(self.outfile+'/'+dstdir)) == 0:
+                os.rmdir(self.outfile+'/'+dstdir)
 
     # nop, we did everything during prepare
     def render(self):
@@ -2,6 +2,7 @@
 
 import argparse
 import datetime
+import hashlib
 import itertools
 import sys
 import os
@@ -18,32 +19,12 @@ import dmt.helpers as helpers
 
 OUTFILE='mirror-info'
 HISTORY_HOURS=24*7
+MODES = ('bulk', 'per-site')
+# rows to fetch at a time when streaming the history of all sites
+HISTORY_ITERSIZE = 10000
 
-
-class MirrorReport():
-    def __init__(self,
-            site, allsitenames,
-            mastertraces_lastseen,
-            traceset_elem_ctr,
-            history_hours=HISTORY_HOURS, outfile=OUTFILE, **kwargs):
-        self.outfile = outfile
-        self.site = site
-        self.allsitenames = allsitenames
-        self.history_hours = history_hours
-        self.mastertraces_lastseen = mastertraces_lastseen
-        self.traceset_elem_ctr = traceset_elem_ctr
-        self.template_name = 'mirror-report.html'
-
-    def prepare(self, dbh):
-        cur = dbh.cursor()
-        cur2 = dbh.cursor()
-
-        now = datetime.datetime.now()
-        checkrun = helpers.get_latest_checkrun(cur)
-        check_age_cutoff = now - datetime.timedelta(hours=self.history_hours)
-
-        cur.execute("""
-            SELECT
+# what MirrorReport shows of each checkrun
+HISTORY_COLUMNS = """
                 checkrun.timestamp as checkrun_timestamp,
 
                 mastertrace.id AS mastertrace_id,
@@ -53,7 +34,7 @@ class MirrorReport():
                 sitetrace.id AS sitetrace_id,
                 sitetrace.error AS sitetrace_error,
                 sitetrace.trace_timestamp AS sitetrace_trace_timestamp,
-                encode(digest(sitetrace.full, 'sha256'), 'hex') as sitetrace_trace_digest,
+                sitetrace.full_digest AS sitetrace_trace_digest,
                 sitetrace.archive_update_in_progress AS sitetrace_archive_update_in_progress,
                 sitetrace.archive_update_required AS sitetrace_archive_update_required,
 
@@ -67,14 +48,51 @@ class MirrorReport():
                 checkoverview.age AS checkoverview_age,
                 checkoverview.aliases AS checkoverview_aliases,
                 checkoverview.score AS checkoverview_score
+    """
+
+
+class MirrorReport():
+    """The report page of a site, showing its checks over the last history_hours.
 
+    Unless history, the rows of HISTORY_COLUMNS for the site's checkruns, is
+    given along with now and last_run, the timestamp of the latest checkrun,
+    prepare() queries them.  What all pages show alike, like the names of
+    all sites, is read from the helpers.RunSnapshot the renderers share
+    instead of being handed to every page.
+
+    fingerprint, if given, is that of the page's inputs, to be recorded in
+    the manifest of its directory once the page is rendered.
+    """
+    def __init__(self,
+            site,
+            history_hours=HISTORY_HOURS, outfile=OUTFILE,
+            history=None, now=None, last_run=None, fingerprint=None, **kwargs):
+        self.outfile = outfile
+        self.fingerprint = fingerprint
+        self.site = site
+        self.history_hours = history_hours
+        self.history = history
+        self.now = now
+        self.last_run = last_run
+        self.template_name = 'mirror-report.html'
+
+    def fetch_history(self, dbh):
+        cur = dbh.cursor()
+
+        self.now = datetime.datetime.now()
+        self.last_run = helpers.get_run_snapshot(dbh).checkrun['timestamp']
+        check_age_cutoff = self.now - datetime.timedelta(hours=self.history_hours)
+
+        cur.execute("""
+            SELECT
+                %(columns)s
             FROM checkrun LEFT OUTER JOIN
-                (SELECT * FROM mastertrace   WHERE site_id = %(site_id)s) AS mastertrace   ON checkrun.id = mastertrace.checkrun_id LEFT OUTER JOIN
-                (SELECT * FROM sitetrace     WHERE site_id = %(site_id)s) AS sitetrace     ON checkrun.id = sitetrace.checkrun_id LEFT OUTER JOIN
-                (SELECT * FROM traceset      WHERE site_id = %(site_id)s) AS traceset      ON checkrun.id = traceset.checkrun_id LEFT OUTER JOIN
-                (SELECT * FROM checkoverview WHERE site_id = %(site_id)s) AS checkoverview ON checkrun.id = checkoverview.checkrun_id
+                (SELECT * FROM mastertrace_run   WHERE site_id = %%(site_id)s AND checkrun_timestamp >= %%(check_age_cutoff)s) AS mastertrace   ON checkrun.id = mastertrace.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM sitetrace_run     WHERE site_id = %%(site_id)s AND checkrun_timestamp >= %%(check_age_cutoff)s) AS sitetrace     ON checkrun.id = sitetrace.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM traceset_run      WHERE site_id = %%(site_id)s AND checkrun_timestamp >= %%(check_age_cutoff)s) AS traceset      ON checkrun.id = traceset.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM checkoverview WHERE site_id = %%(site_id)s AND checkrun_timestamp >= %%(check_age_cutoff)s) AS checkoverview ON checkrun.id = checkoverview.checkrun_id
             WHERE
-                checkrun.timestamp >= %(check_age_cutoff)s
+                checkrun.timestamp >= %%(check_age_cutoff)s
               AND
                 (
                 mastertrace.id IS NOT NULL
@@ -87,15 +105,24 @@ class MirrorReport():
                 )
             ORDER BY
                 checkrun.timestamp
-            """, {
+            """ % {
+                'columns': HISTORY_COLUMNS,
+            }, {
                 'check_age_cutoff': check_age_cutoff,
                 'site_id': self.site['id'],
             })
+        # plain dicts, as the page may be passed to a renderer
+        self.history = [dict(row) for row in cur.fetchall()]
+
+    def prepare(self, dbh):
+        if self.history is None:
+            self.fetch_history(dbh)
+        snapshot = helpers.get_run_snapshot(dbh)
 
         track_items = ['mastertrace_trace_timestamp', 'sitetrace_trace_timestamp', 'checkoverview_version']
         prev = {x: None for x in track_items}
         checks = []
-        for row in cur.fetchall():
+        for row in self.history:
             for x in track_items:
                 if row[x] is not None:
                     if prev[x] is not None and prev[x] != row[x]:
@@ -106,16 +133,16 @@ class MirrorReport():
                     raise Exception("Hmm.  traceset_traceset for traceset_id %s is not a list"%(row['traceset_id'], ))
                 if 'master' in row['traceset_traceset']:
                     row['traceset_traceset'].remove('master')
-                row['traceset_traceset'].sort(key=lambda traceset_elem: -self.traceset_elem_ctr.get(traceset_elem, 0))
+                row['traceset_traceset'].sort(key=lambda traceset_elem: -snapshot.traceset_elem_ctr.get(traceset_elem, 0))
             row['aliases' ] = row['checkoverview_aliases']
             checks.append(row)
 
         context = {
             'baseurl': '..',
-            'now': now,
-            'last_run': checkrun['timestamp'],
+            'now': self.now,
+            'last_run': self.last_run,
             'checks': reversed(checks),
-            'allsitenames': self.allsitenames,
+            'allsitenames': snapshot.sitenames,
         }
         context['site'] = {
             'name'     : self.site['name'],
@@ -129,53 +156,157 @@ class MirrorReport():
 
 
 class Generator():
-    def __init__(self, outfile = OUTFILE, **kwargs):
+    """Make a MirrorReport page for every site.
+
+    In bulk history_mode, the history of all sites is fetched in one query
+    and handed to the pages, instead of every page querying its own.
+
+    With incremental, pages whose inputs have not changed since they were
+    last rendered, going by the fingerprints in the manifest in outfile,
+    are skipped.  The fingerprints are of the histories, so those are
+    fetched in bulk whatever the history_mode.
+    """
+    TEMPLATES = ('mirror-report.html', 'base.html')
+
+    def __init__(self, outfile = OUTFILE, templatedir = 'templates', incremental = False, history_mode = 'bulk', **kwargs):
         self.outfile = outfile
+        self.templatedir = templatedir
+        self.incremental = incremental
+        self.history_mode = history_mode
+
+    def get_template_digests(self):
+        digests = []
+        for name in self.TEMPLATES:
+            with open(os.path.join(self.templatedir, name), 'rb') as f:
+                digests.append(hashlib.sha256(f.read()).hexdigest())
+        return digests
+
+    @staticmethod
+    def get_fingerprint(site, history, snapshot, template_digests):
+        """Fingerprint the inputs of site's page, given its history.
+
+        That is the site, its checks, the site's bugs and the templates,
+        and of the other sites only what the page shows: which of the
+        traces in its tracesets are sites, and how common those traces are.
+        When the latest checkrun was and when the page was generated are
+        left out: the footer gets the former from the last-run.js generate
+        writes, and the latter stays true of the page as it is.
+        """
+        traces = set()
+        for row in history:
+            if isinstance(row['traceset_traceset'], list):
+                traces.update(row['traceset_traceset'])
+        return helpers.get_fingerprint(
+            [site[x] for x in ('name', 'http_override_host', 'http_override_port', 'http_path')],
+            history,
+            [(trace, trace in snapshot.sites, snapshot.traceset_elem_ctr.get(trace, 0)) for trace in sorted(traces)],
+            list(helpers.get_bugs_for_mirror(site['name'])),
+            template_digests)
+
+    @staticmethod
+    def get_histories(dbh, site_ids, check_age_cutoff):
+        """Yield (site_id, rows of HISTORY_COLUMNS) for those of site_ids with checks since check_age_cutoff, by site.
+
+        The rows are streamed through a server-side cursor, so only one
+        site's worth of them is held at a time.
+        """
+        cur = dbh.cursor(name='mirrorinfo_history')
+        cur.itersize = HISTORY_ITERSIZE
+        cur.execute("""
+            SELECT
+                site.id AS site_id,
+                %(columns)s
+            FROM site CROSS JOIN
+                checkrun LEFT OUTER JOIN
+                mastertrace_run   AS mastertrace   ON mastertrace.site_id   = site.id AND mastertrace.checkrun_id   = checkrun.id AND mastertrace.checkrun_timestamp   >= %%(check_age_cutoff)s LEFT OUTER JOIN
+                sitetrace_run     AS sitetrace     ON sitetrace.site_id     = site.id AND sitetrace.checkrun_id     = checkrun.id AND sitetrace.checkrun_timestamp     >= %%(check_age_cutoff)s LEFT OUTER JOIN
+                traceset_run      AS traceset      ON traceset.site_id      = site.id AND traceset.checkrun_id      = checkrun.id AND traceset.checkrun_timestamp      >= %%(check_age_cutoff)s LEFT OUTER JOIN
+                checkoverview                      ON checkoverview.site_id = site.id AND checkoverview.checkrun_id = checkrun.id AND checkoverview.checkrun_timestamp >= %%(check_age_cutoff)s
+            WHERE
+                site.id = ANY(%%(site_ids)s)
+              AND
+                checkrun.timestamp >= %%(check_age_cutoff)s
+              AND
+                (
+                mastertrace.id IS NOT NULL
+                OR
+                sitetrace.id IS NOT NULL
+                OR
+                traceset.id IS NOT NULL
+                OR
+                checkoverview.id IS NOT NULL
+                )
+            ORDER BY
+                site.id,
+                checkrun.timestamp
+            """ % {
+                'columns': HISTORY_COLUMNS,
+            }, {
+                'check_age_cutoff': check_age_cutoff,
+                'site_ids': site_ids,
+            })
+        for (site_id, rows) in itertools.groupby(cur, key=lambda row: row['site_id']):
+            # plain dicts, to be passed to the renderers
+            rows = [dict(row) for row in rows]
+            for row in rows:
+                del row['site_id']
+            yield (site_id, rows)
+        cur.close()
 
     def get_pages(self, dbh):
         outdir = self.outfile
         if not os.path.isdir(outdir):
             os.mkdir(outdir)
 
-        cur = dbh.cursor()
-        mastertraces_lastseen = helpers.get_ftpmaster_traces_lastseen(cur)
+        snapshot = helpers.get_run_snapshot(dbh)
+        sites = snapshot.sites
 
-        sites = {}
-        cur.execute("""
-            SELECT
-                site.id,
-                site.name,
-                site.http_override_host,
-                site.http_override_port,
-                site.http_path,
+        # the output directory may be kept between runs, so drop the pages
+        # of sites that are gone
+        for name in os.listdir(outdir):
+            if name.endswith('.html') and name[:-len('.html')] not in sites:
+                os.unlink(os.path.join(outdir, name))
 
-                traceset.traceset::jsonb AS traceset_traceset
-            FROM site LEFT JOIN
-                (
-                 SELECT *
-                   FROM traceset
-                   WHERE checkrun_id = (SELECT id FROM checkrun ORDER BY checkrun.timestamp LIMIT 1)
-                ) AS traceset ON site.id = traceset.site_id
-            """)
-
-        traceset_elem_ctr = {}
-        for row in cur.fetchall():
-            sites[row['name']] = row
-            if row['traceset_traceset'] is not None:
-                if not isinstance(row['traceset_traceset'], list):
-                    raise Exception("Hmm.  traceset_traceset for site %s(%s) is not a list"%(row['id'], row['name']))
-                for traceset_elem in row['traceset_traceset']:
-                    traceset_elem_ctr[traceset_elem] = traceset_elem_ctr.get(traceset_elem, 0) + 1
+        if self.incremental:
+            manifest = helpers.Manifest(outdir)
+            template_digests = self.get_template_digests()
+
+        todo = list(sites.values())
+        # the fingerprints are of the histories, so incremental runs need them up front
+        bulk = self.history_mode == 'bulk' or self.incremental
+        if bulk:
+            now = datetime.datetime.now()
+            checkrun = snapshot.checkrun
+            todo.sort(key=lambda site: site['id'])
+            histories = self.get_histories(dbh, [site['id'] for site in todo], now - datetime.timedelta(hours=HISTORY_HOURS))
+            next_history = next(histories, None)
 
-        for site in sites.values():
-            of = os.path.join(outdir, site['name'] + '.html')
+        for site in todo:
+            name = site['name'] + '.html'
+            kwargs = {}
+            if bulk:
+                # sites without checks in the window have no rows in the stream
+                if next_history is not None and next_history[0] == site['id']:
+                    history = next_history[1]
+                    next_history = next(histories, None)
+                else:
+                    history = []
+                kwargs = {
+                    'history': history,
+                    'now': now,
+                    'last_run': checkrun['timestamp'],
+                }
+            if self.incremental:
+                fingerprint = self.get_fingerprint(site, history, snapshot, template_digests)
+                if manifest.unchanged(name, fingerprint):
+                    continue
+                # the manifest learns of it once it is rendered, see helpers.record_rendered()
+                kwargs['fingerprint'] = fingerprint
             i = MirrorReport(
                     base=self,
-                    outfile=of,
+                    outfile=os.path.join(outdir, name),
                     site=site,
-                    allsitenames=list(sites.keys()),
-                    mastertraces_lastseen=mastertraces_lastseen,
-                    traceset_elem_ctr=traceset_elem_ctr)
+                    **kwargs)
             yield i
 
 
@@ -186,11 +317,17 @@ if __name__ == "__main__":
     parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
     parser.add_argument('--templatedir', help='template directory', default='templates')
     parser.add_argument('--outfile', help='output-dir', default=OUTFILE)
+    parser.add_argument('--incremental', help='only render pages whose inputs changed since the last run', action='store_true', default=False)
+    parser.add_argument('--history-mode', help='fetch the history of all sites in one query, or have each page query its own', choices=MODES, default='bulk')
     args = parser.parse_args()
 
     base = BasePageRenderer(**args.__dict__)
     dbh = db.RawDB(args.dburl)
     g = Generator(**args.__dict__)
+    rendered = []
     for x in g.get_pages(dbh):
         x.prepare(dbh)
         base.render(x)
+        if x.fingerprint is not None:
+            rendered.append((x.outfile, x.fingerprint))
+    helpers.record_rendered(rendered)
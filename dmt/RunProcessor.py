@@ -1,9 +1,12 @@
 #!/usr/bin/python3
 
 import argparse
+import collections
 import datetime
 import itertools
 import json
+from multiprocessing.pool import ThreadPool
+import psycopg2.extras
 import sys
 import os
 
@@ -17,6 +20,128 @@ if __name__ == '__main__' and __package__ is None:
 import dmt.db as db
 import dmt.helpers as helpers
 
+MODES = ('bulk', 'per-site')
+
+CHECKOVERVIEW_VALUES = '(%(site_id)s, %(checkrun_id)s, %(checkrun_timestamp)s, %(error)s, %(version)s, %(age)s, %(aliases)s)'
+
+def record_versions(cur, site_rows):
+    """Record the master version of the sitetrace timestamps in site_rows in sitetraceversion.
+
+    site_rows are (site_id, row) for checkruns about to be processed, in
+    the order of the checkruns for each site.  The version we think a mirror
+    is at is the contents of the master tracefile the last time the site
+    tracefile got updated, i.e., in the earliest checkrun that saw both.
+    Earlier checkruns have been recorded when they were processed, so what
+    is there already stays.
+    """
+    versions = collections.OrderedDict()
+    for (site_id, row) in site_rows:
+        if row['sitetrace_trace_timestamp'] is not None and row['mastertrace_trace_timestamp'] is not None:
+            versions.setdefault((site_id, row['sitetrace_trace_timestamp']), row['mastertrace_trace_timestamp'])
+    if len(versions) > 0:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO sitetraceversion (site_id, sitetrace_trace_timestamp, mastertrace_trace_timestamp)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            """, [key + (version,) for (key, version) in versions.items()], page_size=1000)
+
+def get_versions(cur, keys):
+    """Look up the master versions of keys, which are (site_id, sitetrace timestamp).
+
+    Returns a dict of the keys we know a version for.
+    """
+    keys = sorted(key for key in keys if key[1] is not None)
+    cur.execute("""
+        SELECT
+            site_id,
+            sitetrace_trace_timestamp,
+            mastertrace_trace_timestamp
+        FROM sitetraceversion
+        WHERE
+            (site_id, sitetrace_trace_timestamp) IN (SELECT * FROM unnest(%(site_ids)s::integer[], %(sitetrace_trace_timestamps)s::timestamptz[]))
+        """, {
+            'site_ids': [key[0] for key in keys],
+            'sitetrace_trace_timestamps': [key[1] for key in keys],
+        })
+    versions = {}
+    for row in cur.fetchall():
+        versions[(row['site_id'], row['sitetrace_trace_timestamp'])] = row['mastertrace_trace_timestamp']
+    return versions
+
+def set_age(data, checkrun_timestamp, mastertraces_lastseen):
+    """Set the age of data['version'] as of checkrun_timestamp, or the error if we don't know that version.
+    """
+    lastseen = mastertraces_lastseen.get(data['version'])
+    if lastseen is not None:
+        if lastseen > checkrun_timestamp:
+            data['age'] = datetime.timedelta(0)
+        else:
+            data['age'] = checkrun_timestamp - lastseen
+    else:
+        data['error'] = 'unexpected mirror version: ' + str(data['version'])
+
+def carry_forward(site_id, row, prev, mastertraces_lastseen):
+    """The checkoverview of row, a checkrun in which site_id was skipped, going by prev, its last result.
+    """
+    data = {}
+    data['site_id'] = site_id
+    data['checkrun_id'] = row['checkrun_id']
+    data['checkrun_timestamp'] = row['checkrun_timestamp']
+    data['error'] = prev['error']
+    data['version'] = prev['version']
+    data['age'] = None
+    data['aliases'] = prev['aliases']
+    if data['error'] is None:
+        set_age(data, row['checkrun_timestamp'], mastertraces_lastseen)
+    return data
+
+def summarize(site_id, row, alias_rows, get_version, mastertraces_lastseen):
+    """The checkoverview of row, a checkrun of site_id, given the results of the site's aliases in that checkrun.
+
+    get_version(sitetrace_trace_timestamp) returns the master trace timestamp
+    the site had when its tracefile got that timestamp, or None if we do not know.
+    """
+    aliases = {}
+    for row2 in alias_rows:
+        if row2['sitealiasmastertrace_id'] is None:
+            continue
+        d = {}
+        if row2['sitealiasmastertrace_error'] is not None:
+            d['error'] = row2['sitealiasmastertrace_error']
+            d['ok'] = False
+        elif row2['sitealiasmastertrace_trace_timestamp'] == row['mastertrace_trace_timestamp']:
+            d['ok'] = True
+        else:
+            d['ok'] = True
+        aliases[row2['sitealias_name']] = d
+    aliases = json.dumps(aliases, separators=(',', ':'))
+
+    errors = []
+    for kind in ('master', 'site'):
+        if row[kind+'trace_error'] is not None:
+            errors.append(kind+"trace: "+row[kind+'trace_error'])
+        elif row[kind+'trace_trace_timestamp'] is None:
+            errors.append(kind+"trace unavailable")
+
+    data = {}
+    data['site_id'] = site_id
+    data['checkrun_id'] = row['checkrun_id']
+    data['checkrun_timestamp'] = row['checkrun_timestamp']
+    data['error'] = None
+    data['version'] = None
+    data['age'] = None
+    data['aliases'] = aliases
+    if len(errors) > 0:
+        data['error'] = '; '.join(errors)
+    else:
+        version = get_version(row['sitetrace_trace_timestamp'])
+        if version is None:
+            data['error'] = 'mastertrace validity uncertain'
+        else:
+            data['version'] = version
+            set_age(data, row['checkrun_timestamp'], mastertraces_lastseen)
+    return data
+
 class MirrorProcessor():
     def __init__(self, site, mastertraces_lastseen):
         self.site = site
@@ -44,13 +169,19 @@ class MirrorProcessor():
 
                 sitetrace.id AS sitetrace_id,
                 sitetrace.error AS sitetrace_error,
-                sitetrace.trace_timestamp AS sitetrace_trace_timestamp
+                sitetrace.trace_timestamp AS sitetrace_trace_timestamp,
+
+                siteskip.id AS siteskip_id
 
             FROM checkrun LEFT OUTER JOIN
-                (SELECT * FROM mastertrace WHERE site_id = %(site_id)s) AS mastertrace ON checkrun.id = mastertrace.checkrun_id LEFT OUTER JOIN
-                (SELECT * FROM sitetrace   WHERE site_id = %(site_id)s) AS sitetrace   ON checkrun.id = sitetrace.checkrun_id
+                (SELECT * FROM mastertrace_run WHERE site_id = %(site_id)s) AS mastertrace ON checkrun.id = mastertrace.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM sitetrace_run   WHERE site_id = %(site_id)s) AS sitetrace   ON checkrun.id = sitetrace.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM siteskip    WHERE site_id = %(site_id)s) AS siteskip    ON checkrun.id = siteskip.checkrun_id
             WHERE
-              -- Select check runs that have not been processed yet
+              -- Select check runs that are complete
+                checkrun.completed
+              AND
+              -- and have not been processed yet
                 checkrun.id NOT in (SELECT checkrun_id FROM checkoverview WHERE site_id = %(site_id)s)
               AND
               -- assuming they are either newer than previously processed ones
@@ -97,8 +228,38 @@ class MirrorProcessor():
 #            WHERE
 #                checkrun.id NOT in (SELECT checkrun_id FROM checkoverview WHERE site_id = %(site_id)s)
 
-        cache = {}
-        for row in cur.fetchall():
+        rows = cur.fetchall()
+
+        # The last result we have for this site, to carry forward over checkruns
+        # in which the site was not due for checking.
+        cur.execute("""
+            SELECT
+                checkoverview.error,
+                checkoverview.version,
+                checkoverview.aliases
+            FROM checkoverview JOIN
+                checkrun ON checkrun.id = checkoverview.checkrun_id
+            WHERE
+                site_id = %(site_id)s
+            ORDER BY
+                checkrun.timestamp DESC
+            LIMIT 1
+            """, {
+                'site_id': self.site['id'],
+            })
+        prev = cur.fetchone()
+        if prev is not None:
+            prev['aliases'] = json.dumps(prev['aliases'], separators=(',', ':'))
+
+        record_versions(cur2, ((self.site['id'], row) for row in rows))
+        versions = get_versions(cur2, set((self.site['id'], row['sitetrace_trace_timestamp']) for row in rows))
+        get_version = lambda sitetrace_trace_timestamp: versions.get((self.site['id'], sitetrace_trace_timestamp))
+
+        for row in rows:
+            if row['siteskip_id'] is not None and prev is not None:
+                self._insert(cur2, carry_forward(self.site['id'], row, prev, self.mastertraces_lastseen))
+                continue
+
             cur2.execute("""
                 SELECT
                     sitealias.name as sitealias_name,
@@ -108,7 +269,7 @@ class MirrorProcessor():
                     sitealiasmastertrace.trace_timestamp AS sitealiasmastertrace_trace_timestamp
 
                 FROM sitealias LEFT OUTER JOIN
-                    sitealiasmastertrace ON sitealias.id = sitealiasmastertrace.sitealias_id
+                    sitealiasmastertrace_run AS sitealiasmastertrace ON sitealias.id = sitealiasmastertrace.sitealias_id
                 WHERE
                     site_id = %(site_id)s AND
                     checkrun_id = %(checkrun_id)s
@@ -118,81 +279,212 @@ class MirrorProcessor():
                     'site_id': self.site['id'],
                     'checkrun_id': row['checkrun_id'],
                 })
-            aliases = {}
-            for row2 in cur2.fetchall():
-                if row2['sitealiasmastertrace_id'] is None:
+            data = summarize(self.site['id'], row, cur2.fetchall(), get_version, self.mastertraces_lastseen)
+            self._insert(cur2, data)
+            prev = data
+        dbh.commit()
+
+    @staticmethod
+    def _insert(cur, data):
+        cur.execute("""INSERT INTO checkoverview (site_id, checkrun_id, checkrun_timestamp, error, version, age, aliases)
+                       VALUES """ + CHECKOVERVIEW_VALUES,
+                    data)
+
+class BulkProcessor():
+    """Process the new checkruns of all sites at once.
+
+    This gives the same checkoverview rows as running a MirrorProcessor for
+    every site, but fetches what it needs for all sites in a few queries
+    and inserts the results in one go, instead of querying per site, per
+    checkrun and per version.
+
+    If site_ids is given, only those sites are processed.
+    """
+    def __init__(self, mastertraces_lastseen, site_ids=None):
+        self.mastertraces_lastseen = mastertraces_lastseen
+        self.site_ids = site_ids
+
+    def process(self, dbh):
+        results = self.summarize(dbh)
+        if len(results) > 0:
+            self.insert(dbh.cursor(), results)
+        dbh.commit()
+
+    def summarize(self, dbh):
+        """Work out the checkoverview rows of the new checkruns, in order of site and checkrun.
+
+        This also records the versions of new sitetrace timestamps; it
+        does not commit.
+        """
+        cur = dbh.cursor()
+
+        # The same checkruns MirrorProcessor.process selects, for all sites.
+        cur.execute("""
+            SELECT
+                site.id as site_id,
+                checkrun.id as checkrun_id,
+                checkrun.timestamp as checkrun_timestamp,
+
+                mastertrace.id AS mastertrace_id,
+                mastertrace.error AS mastertrace_error,
+                mastertrace.trace_timestamp AS mastertrace_trace_timestamp,
+
+                sitetrace.id AS sitetrace_id,
+                sitetrace.error AS sitetrace_error,
+                sitetrace.trace_timestamp AS sitetrace_trace_timestamp,
+
+                siteskip.id AS siteskip_id
+
+            FROM site CROSS JOIN
+                checkrun LEFT OUTER JOIN
+                (SELECT site_id, max(checkrun_timestamp) AS checkrun_timestamp
+                 FROM checkoverview
+                 GROUP BY site_id) AS processed ON processed.site_id = site.id LEFT OUTER JOIN
+                mastertrace_run AS mastertrace ON mastertrace.site_id = site.id AND mastertrace.checkrun_id = checkrun.id LEFT OUTER JOIN
+                sitetrace_run   AS sitetrace   ON sitetrace.site_id   = site.id AND sitetrace.checkrun_id   = checkrun.id LEFT OUTER JOIN
+                siteskip                       ON siteskip.site_id    = site.id AND siteskip.checkrun_id    = checkrun.id
+            WHERE
+                (%(site_ids)s::integer[] IS NULL OR site.id = ANY(%(site_ids)s))
+              AND
+                checkrun.completed
+              AND
+                NOT EXISTS (SELECT * FROM checkoverview WHERE checkoverview.site_id = site.id AND checkoverview.checkrun_id = checkrun.id)
+              AND
+                (checkrun.timestamp > processed.checkrun_timestamp
+                OR
+                 mastertrace.id IS NOT NULL
+                OR
+                 sitetrace.id IS NOT NULL
+                )
+            ORDER BY
+                site.id,
+                checkrun.timestamp
+            """, {
+                'site_ids': self.site_ids,
+            })
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            return []
+        site_ids = sorted(set(row['site_id'] for row in rows))
+        checkrun_ids = sorted(set(row['checkrun_id'] for row in rows))
+
+        # The last result we have for each site
+        cur.execute("""
+            SELECT DISTINCT ON (site_id)
+                site_id,
+                error,
+                version,
+                aliases
+            FROM checkoverview
+            WHERE
+                site_id = ANY(%(site_ids)s)
+            ORDER BY
+                site_id,
+                checkrun_timestamp DESC
+            """, {
+                'site_ids': site_ids,
+            })
+        prevs = {}
+        for prev in cur.fetchall():
+            prev['aliases'] = json.dumps(prev['aliases'], separators=(',', ':'))
+            prevs[prev['site_id']] = prev
+
+        cur.execute("""
+            SELECT
+                sitealias.site_id,
+                sitealiasmastertrace.checkrun_id,
+
+                sitealias.name as sitealias_name,
+
+                sitealiasmastertrace.id AS sitealiasmastertrace_id,
+                sitealiasmastertrace.error AS sitealiasmastertrace_error,
+                sitealiasmastertrace.trace_timestamp AS sitealiasmastertrace_trace_timestamp
+
+            FROM sitealias JOIN
+                sitealiasmastertrace_run AS sitealiasmastertrace ON sitealias.id = sitealiasmastertrace.sitealias_id
+            WHERE
+                sitealias.site_id = ANY(%(site_ids)s) AND
+                sitealiasmastertrace.checkrun_id = ANY(%(checkrun_ids)s)
+            ORDER BY
+                sitealias.name
+            """, {
+                'site_ids': site_ids,
+                'checkrun_ids': checkrun_ids,
+            })
+        alias_rows = {}
+        for row2 in cur.fetchall():
+            alias_rows.setdefault((row2['site_id'], row2['checkrun_id']), []).append(row2)
+
+        record_versions(cur, ((row['site_id'], row) for row in rows))
+        versions = get_versions(cur, set((row['site_id'], row['sitetrace_trace_timestamp']) for row in rows))
+
+        results = []
+        for site_id, site_rows in itertools.groupby(rows, key=lambda row: row['site_id']):
+            prev = prevs.get(site_id)
+            for row in site_rows:
+                if row['siteskip_id'] is not None and prev is not None:
+                    results.append(carry_forward(site_id, row, prev, self.mastertraces_lastseen))
                     continue
-                d = {}
-                if row2['sitealiasmastertrace_error'] is not None:
-                    d['error'] = row2['sitealiasmastertrace_error']
-                    d['ok'] = False
-                elif row2['sitealiasmastertrace_trace_timestamp'] == row['mastertrace_trace_timestamp']:
-                    d['ok'] = True
-                else:
-                    d['ok'] = True
-                aliases[row2['sitealias_name']] = d
-            aliases = json.dumps(aliases, separators=(',', ':'))
-
-            errors = []
-            for kind in ('master', 'site'):
-                if row[kind+'trace_error'] is not None:
-                    errors.append(kind+"trace: "+row[kind+'trace_error'])
-                elif row[kind+'trace_trace_timestamp'] is None:
-                    errors.append(kind+"trace unavailable")
-
-            data = {}
-            data['site_id'] = self.site['id']
-            data['checkrun_id'] = row['checkrun_id']
-            data['error'] = None
-            data['version'] = None
-            data['age'] = None
-            data['aliases'] = aliases
-            if len(errors) > 0:
-                data['error'] = '; '.join(errors)
-            else:
-                if row['sitetrace_trace_timestamp'] in cache:
-                    res = cache[row['sitetrace_trace_timestamp']]
-                else:
-                    # compute version and age
-                    ##
-                    # The version we think this mirror is at is the contents of the master tracefile
-                    # the last time the site tracefile got updated, i.e., the earliest time the
-                    # sitetrace existed.
-                    #
-                    # Only consider checkruns where we got both, a mastertrace and a sitetrace.
-                    cur2.execute("""
-                        SELECT
-                            mastertrace.trace_timestamp AS mastertrace_trace_timestamp
-                        FROM checkrun JOIN
-                            (SELECT * FROM mastertrace WHERE site_id = %(site_id)s) AS mastertrace ON checkrun.id = mastertrace.checkrun_id JOIN
-                            (SELECT * FROM sitetrace   WHERE site_id = %(site_id)s) AS sitetrace   ON checkrun.id = sitetrace.checkrun_id
-                        WHERE
-                            sitetrace.trace_timestamp = %(sitetrace_trace_timestamp)s AND
-                            mastertrace.trace_timestamp IS NOT NULL
-                        ORDER BY
-                            checkrun.timestamp ASC
-                        LIMIT 1
-                        """, {
-                            'site_id': self.site['id'],
-                            'sitetrace_trace_timestamp': row['sitetrace_trace_timestamp']
-                        })
-                    res = cur2.fetchone()
-                    cache[row['sitetrace_trace_timestamp']] = res
-                if res is None:
-                    data['error'] = 'mastertrace validity uncertain'
-                else:
-                    data['version'] = res['mastertrace_trace_timestamp']
-
-                    if data['version'] in self.mastertraces_lastseen:
-                        if self.mastertraces_lastseen[data['version']] > row['checkrun_timestamp']:
-                            data['age'] = datetime.timedelta(0)
-                        else:
-                            data['age'] = row['checkrun_timestamp'] - self.mastertraces_lastseen[data['version']]
-                    else:
-                        data['error'] = 'unexpected mirror version: ' + str(data['version'])
-            cur2.execute("""INSERT INTO checkoverview (site_id, checkrun_id, error, version, age, aliases)
-                            VALUES (%(site_id)s, %(checkrun_id)s, %(error)s, %(version)s, %(age)s, %(aliases)s)""",
-                         data)
+                data = summarize(site_id, row, alias_rows.get((site_id, row['checkrun_id']), []),
+                                 lambda sitetrace_trace_timestamp, site_id=site_id: versions.get((site_id, sitetrace_trace_timestamp)),
+                                 self.mastertraces_lastseen)
+                results.append(data)
+                prev = data
+        return results
+
+    @staticmethod
+    def insert(cur, results):
+        psycopg2.extras.execute_values(cur,
+            """INSERT INTO checkoverview (site_id, checkrun_id, checkrun_timestamp, error, version, age, aliases) VALUES %s""",
+            results, template=CHECKOVERVIEW_VALUES, page_size=1000)
+
+class ParallelProcessor():
+    """Process the new checkruns of all sites with a pool of workers.
+
+    Sites are independent, so they are dealt round-robin into one shard per
+    worker, and each worker summarizes its shard like BulkProcessor, on a
+    connection of its own from a pool.  mastertraces_lastseen is loaded once
+    and only read by the workers.  Their results are merged in order of site
+    and checkrun and inserted in a single transaction, so the outcome is the
+    same, down to the order of the rows, whatever the number of workers.
+    """
+    def __init__(self, mastertraces_lastseen, dburl, workers):
+        self.mastertraces_lastseen = mastertraces_lastseen
+        self.dburl = dburl
+        self.workers = workers
+
+    def _summarize(self, dbpool, site_ids):
+        with dbpool.connection() as dbh:
+            results = BulkProcessor(self.mastertraces_lastseen, site_ids).summarize(dbh)
+            # the versions recorded are of this shard's sites only
+            dbh.commit()
+        return results
+
+    def process(self, dbh):
+        cur = dbh.cursor()
+        cur.execute("""
+            SELECT id
+            FROM site
+            ORDER BY
+                id
+            """)
+        site_ids = [row['id'] for row in cur.fetchall()]
+        shards = [site_ids[i::self.workers] for i in range(self.workers)]
+        shards = [shard for shard in shards if len(shard) > 0]
+        if len(shards) == 0:
+            return
+
+        dbpool = db.RawDBPool(self.dburl, maxconn=len(shards))
+        pool = ThreadPool(processes=len(shards))
+        try:
+            shard_results = pool.map(lambda shard: self._summarize(dbpool, shard), shards)
+        finally:
+            pool.terminate()
+            dbpool.close()
+
+        results = sorted(itertools.chain.from_iterable(shard_results), key=lambda data: (data['site_id'], data['checkrun_timestamp']))
+        if len(results) > 0:
+            BulkProcessor.insert(cur, results)
         dbh.commit()
 
 class Processor():
@@ -210,14 +502,36 @@ class Processor():
         for site in cur.fetchall():
             yield MirrorProcessor(site = site, mastertraces_lastseen = mastertraces_lastseen)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
-    args = parser.parse_args()
+def add_arguments(parser):
+    parser.add_argument('--mode', help='process all sites together with a few queries, or each site on its own', choices=MODES, default='bulk')
+    parser.add_argument('--workers', help='in bulk mode, split the sites among <x> workers, each with its own database connection (default: 1)', type=int)
+
+def check_arguments(parser, args):
+    """Exit through parser.error() if the arguments added by add_arguments() do not go together.
+    """
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.workers is not None and args.mode != 'bulk':
+        parser.error('--workers only applies to --mode bulk')
+
+def main(args=None):
+    if args is None:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+        add_arguments(parser)
+        args = parser.parse_args()
+        check_arguments(parser, args)
 
     dbh = db.RawDB(args.dburl)
-    for x in Processor.process(dbh):
-        x.process(dbh)
+    if args.mode == 'bulk' and args.workers is not None and args.workers > 1:
+        cur = dbh.cursor()
+        ParallelProcessor(mastertraces_lastseen = helpers.get_ftpmaster_traces_lastseen(cur), dburl = args.dburl, workers = args.workers).process(dbh)
+    elif args.mode == 'bulk':
+        cur = dbh.cursor()
+        BulkProcessor(mastertraces_lastseen = helpers.get_ftpmaster_traces_lastseen(cur)).process(dbh)
+    else:
+        for x in Processor.process(dbh):
+            x.process(dbh)
 
 if __name__ == "__main__":
     main()
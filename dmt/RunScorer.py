@@ -2,14 +2,18 @@
 
 import argparse
 import datetime
+import importlib
 import itertools
 import json
+import psycopg2.extras
 import sys
 import os
 
 # ignore checkrun for scoring purposes if more than this fraction
 # of checks resulted in errors
 IGNORE_RUN_THRESHOLD = 0.7
+# sites scoring less than this are left out of the masterlist
+SCORE_CUTOFF = 50.0
 
 if __name__ == '__main__' and __package__ is None:
     from pathlib import Path
@@ -21,128 +25,249 @@ if __name__ == '__main__' and __package__ is None:
 import dmt.db as db
 import dmt.helpers as helpers
 
-class CheckrunScorer():
-    def __init__(self, checkrun):
-        self.checkrun = checkrun
+class ScoringPolicy():
+    """How a site's score changes from one checkrun to the next.
+
+    The adjustment for a checkoverview row, an amount per day, is weighted
+    by the time since the site's previous score, and the score is kept
+    within -100 and 100.  Subclasses decide the adjustment.
+    """
+    # the score of a site before its first checkrun, and the time in seconds
+    # since then that its first adjustment is weighted by
+    INITIAL_SCORE = 0.0
+    INITIAL_DELTA = 300
+
+    def adjustment(self, error, age):
+        """The adjustment per day for a checkoverview with error and age
+        """
+        raise Exception("adjustment called on abstractish base class")
+
+    def score(self, score, delta, ignore_this_run, error, age):
+        """The new score of a site that had score, given its checkoverview error and age
+           in a checkrun delta seconds after the one that score is from.
+
+        For a site's first checkrun, score and delta are None.
+        """
+        if score is None:
+            score = self.INITIAL_SCORE
+            delta = self.INITIAL_DELTA
+        weight = float(delta)/(3600*24)
+
+        if ignore_this_run:
+            adj = 0
+        else:
+            adj = self.adjustment(error, age)
+
+        score += float(adj) * weight
+        if   score >  100: score = 100
+        elif score < -100: score = -100
+        return score
+
+class ThresholdPolicy(ScoringPolicy):
+    """Adjust by how old the mirror is, in steps, and heavily for errors.
+
+    age_adjustments are (age, adjustment), by increasing age: a mirror gets
+    the adjustment of the first age it is not older than, or
+    stale_adjustment if it is older than all of them.
+    """
+    AGE_ADJUSTMENTS = (
+        (datetime.timedelta(hours = 4),  +5),
+        (datetime.timedelta(hours = 12), +1),
+        (datetime.timedelta(hours = 24),  0),
+        (datetime.timedelta(hours = 48), -5),
+    )
+
+    def __init__(self, age_adjustments=AGE_ADJUSTMENTS, stale_adjustment=-30, error_adjustment=-30):
+        self.age_adjustments = age_adjustments
+        self.stale_adjustment = stale_adjustment
+        self.error_adjustment = error_adjustment
+
+    def adjustment(self, error, age):
+        if error is not None:
+            return self.error_adjustment
+        for (max_age, adj) in self.age_adjustments:
+            if age <= max_age:
+                return adj
+        return self.stale_adjustment
+
+POLICIES = {
+    'default': ThresholdPolicy(),
+}
+
+def get_policy(name):
+    """The scoring policy called name in POLICIES, or given as module:attribute
+    """
+    if name in POLICIES:
+        return POLICIES[name]
+    if ':' not in name:
+        raise ValueError("Unknown scoring policy %s"%(name,))
+    (module, attribute) = name.split(':', 1)
+    policy = getattr(importlib.import_module(module), attribute)
+    if isinstance(policy, type):
+        policy = policy()
+    if not isinstance(policy, ScoringPolicy):
+        raise ValueError("%s is not a scoring policy"%(name,))
+    return policy
+
+class Scorer():
+    """Score all checkoverview rows that have no score yet.
+
+    A site's score is carried from one checkrun to the next, so the rows are
+    streamed in order of checkrun and site from the oldest unscored checkrun
+    on, keeping the last score and timestamp of each site in memory, and the
+    new scores are written back in a single UPDATE.
+
+    With recompute_from, rows from checkruns since then are scored again,
+    e.g. after the scoring rules changed, and only scores that change are
+    written.  With dry_run, nothing is written; instead it reports how many
+    scores change, and how many sites in the latest checkrun would cross
+    SCORE_CUTOFF.
+
+    Scores are computed by policy, a ScoringPolicy.
+    """
+    # rows to fetch at a time from the server-side cursor
+    ITERSIZE = 10000
+
+    def __init__(self, policy=POLICIES['default'], recompute_from=None, dry_run=False):
+        self.policy = policy
+        self.recompute_from = recompute_from
+        self.dry_run = dry_run
 
     def process(self, dbh):
         cur = dbh.cursor()
-        cur2 = dbh.cursor()
 
+        recompute_from = None
+        if self.recompute_from is not None:
+            cur.execute("SELECT CAST(%(recompute_from)s AS timestamptz) AS recompute_from", {'recompute_from': self.recompute_from})
+            recompute_from = cur.fetchone()['recompute_from']
+
+        # The checkruns with rows to score, and whether to ignore them
         cur.execute("""
             SELECT
+                checkrun_id,
+                checkrun_timestamp,
                 count(*) AS total,
                 count(error) AS errors
             FROM checkoverview
-            WHERE
-                checkoverview.checkrun_id = %(checkrun_id)s
+            GROUP BY
+                checkrun_id,
+                checkrun_timestamp
+            HAVING
+                count(*) FILTER (WHERE score IS NULL) > 0 OR
+                checkrun_timestamp >= %(recompute_from)s
+            ORDER BY
+                checkrun_timestamp
             """, {
-                'checkrun_id': self.checkrun['id'],
+                'recompute_from': recompute_from,
             })
-        counts = cur.fetchone()
-        ignore_this_run = counts['total'] > 0 and float(counts['errors'])/counts['total'] > IGNORE_RUN_THRESHOLD
-        #if ignore_this_run:
-        #    print("IGNORING THIS RUN for scoring purposes:", counts['errors'], "out of", counts['total'], "failed.")
+        ignore_run = {}
+        start = None
+        for counts in cur.fetchall():
+            ignore_run[counts['checkrun_id']] = counts['total'] > 0 and float(counts['errors'])/counts['total'] > IGNORE_RUN_THRESHOLD
+            if start is None:
+                start = counts['checkrun_timestamp']
+        if start is None:
+            return
 
+        # The last score of each site before that
         cur.execute("""
-            SELECT
-                checkoverview.site_id AS site_id,
-                checkoverview.id      AS checkoverview_id,
-                checkoverview.error   AS checkoverview_error,
-                checkoverview.age     AS checkoverview_age
-
+            SELECT DISTINCT ON (site_id)
+                site_id,
+                checkrun_timestamp,
+                score
             FROM checkoverview
             WHERE
-                checkoverview.checkrun_id = %(checkrun_id)s AND
-                checkoverview.score IS NULL
+                checkrun_timestamp < %(start)s
+            ORDER BY
+                site_id,
+                checkrun_timestamp DESC
             """, {
-                'checkrun_id': self.checkrun['id'],
+                'start': start,
             })
+        prevs = {}
+        for prev in cur.fetchall():
+            prevs[prev['site_id']] = prev
 
-        #print(self.checkrun['timestamp'])
-        for row in cur.fetchall():
-            # Get the previous score for this mirror
-            cur2.execute("""
-                SELECT
-                    checkrun.id         AS checkrun_id,
-                    checkrun.timestamp  AS checkrun_timestamp,
-
-                    checkoverview.score AS checkoverview_score
-                FROM checkrun JOIN
-                    checkoverview ON checkrun.id = checkoverview.checkrun_id
-                WHERE
-                    checkoverview.site_id = %(site_id)s AND
-                    checkrun.timestamp < %(this_checkrun_timestamp)s
-                ORDER BY
-                    checkrun.timestamp DESC
-                LIMIT 1
-                """, {
-                    'site_id': row['site_id'],
-                    'this_checkrun_timestamp': self.checkrun['timestamp']
-                })
-            prev = cur2.fetchone()
-
-            if prev is None:
-                score = 0.0
-                delta = 300 # pick some arbitrary time delta for the first weight
-            else:
-                score = prev['checkoverview_score']
-                if score is None:
-                    raise Exception("Previous score is NULL; that makes no sense")
-                delta = (self.checkrun['timestamp'] - prev['checkrun_timestamp']).total_seconds()
-            weight = float(delta)/(3600*24)
-
-            if ignore_this_run:
-                adj = 0
-            elif row['checkoverview_error'] is not None:
-                adj = -30
-            elif row['checkoverview_age'] <= datetime.timedelta(hours = 4):
-                adj = +5
-            elif row['checkoverview_age'] <= datetime.timedelta(hours = 12):
-                adj = +1
-            elif row['checkoverview_age'] <= datetime.timedelta(hours = 24):
-                adj = 0
-            elif row['checkoverview_age'] <= datetime.timedelta(hours = 48):
-                adj = -5
-            else:
-                adj = -30
-
-            score += float(adj) * weight
-            if   score >  100: score = 100
-            elif score < -100: score = -100
-            #print(self.checkrun['timestamp'], "Mirror is ", row['checkoverview_age'], "old.  Adjusting score by", adj, "; weighted:", float(adj) * weight, "; new score is", score)
-
-            cur2.execute("""UPDATE checkoverview SET score = %(score)s WHERE id=%(checkoverview_id)s""",
-                         {'checkoverview_id': row['checkoverview_id'],
-                          'score': score}
-                        )
-        dbh.commit()
-
-class Scorer():
-    @staticmethod
-    def process(dbh):
-        cur = dbh.cursor()
-        cur.execute("""
+        stream = dbh.cursor(name='scorer')
+        stream.itersize = self.ITERSIZE
+        stream.execute("""
             SELECT
                 id,
-                timestamp
-            FROM checkrun
-            WHERE EXISTS
-              (SELECT * FROM checkoverview WHERE checkoverview.checkrun_id=checkrun.id AND score IS NULL)
+                site_id,
+                checkrun_id,
+                checkrun_timestamp,
+                error,
+                age,
+                score
+            FROM checkoverview
+            WHERE
+                checkrun_timestamp >= %(start)s
             ORDER BY
-                timestamp ASC
-            """)
-        for checkrun in cur.fetchall():
-            yield CheckrunScorer(checkrun = checkrun)
+                checkrun_timestamp,
+                site_id
+            """, {
+                'start': start,
+            })
+        scores = []
+        # site -> (old score, new score) in the latest checkrun
+        latest = {}
+        latest_timestamp = None
+        for row in stream:
+            if row['checkrun_timestamp'] != latest_timestamp:
+                latest.clear()
+                latest_timestamp = row['checkrun_timestamp']
+            if row['score'] is None or (recompute_from is not None and row['checkrun_timestamp'] >= recompute_from):
+                old_score = row['score']
+                prev = prevs.get(row['site_id'])
+                if prev is None:
+                    score = None
+                    delta = None
+                else:
+                    score = prev['score']
+                    if score is None:
+                        raise Exception("Previous score is NULL; that makes no sense")
+                    delta = (row['checkrun_timestamp'] - prev['checkrun_timestamp']).total_seconds()
+                row['score'] = self.policy.score(score, delta, ignore_run[row['checkrun_id']], row['error'], row['age'])
+                if row['score'] != old_score:
+                    scores.append((row['id'], row['checkrun_timestamp'], row['score']))
+                latest[row['site_id']] = (old_score, row['score'])
+            prevs[row['site_id']] = row
+        stream.close()
+
+        if self.dry_run:
+            dropping = [site_id for (site_id, (old, new)) in latest.items() if old is not None and old >= SCORE_CUTOFF and new <  SCORE_CUTOFF]
+            rising   = [site_id for (site_id, (old, new)) in latest.items() if old is not None and old <  SCORE_CUTOFF and new >= SCORE_CUTOFF]
+            print("%d scores would change."%(len(scores),))
+            print("In the latest checkrun, %d sites would drop below the score cutoff of %.1f, and %d would reach it."%(len(dropping), SCORE_CUTOFF, len(rising)))
+            dbh.rollback()
+            return
+        if len(scores) == 0:
+            return
+
+        psycopg2.extras.execute_values(cur, """
+            UPDATE checkoverview
+            SET score = v.score
+            FROM (VALUES %s) AS v (id, checkrun_timestamp, score)
+            WHERE
+                checkoverview.id = v.id AND
+                checkoverview.checkrun_timestamp = v.checkrun_timestamp
+            """, scores, template='(%s::integer, %s::timestamptz, %s::double precision)', page_size=1000)
+        dbh.commit()
+
+def add_arguments(parser):
+    parser.add_argument('--policy', help='scoring policy: one of %s, or module:attribute'%(', '.join(sorted(POLICIES)),), default='default')
+    parser.add_argument('--recompute-from', help='score again all checkruns since <timestamp>, e.g. after changing the scoring rules')
+    parser.add_argument('--dry-run', help='only report how many scores would change, and how many sites would cross the score cutoff; write nothing, not even checkoverview rows for new checkruns', action='store_true', default=False)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
-    args = parser.parse_args()
+def main(args=None):
+    if args is None:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+        add_arguments(parser)
+        args = parser.parse_args()
 
     dbh = db.RawDB(args.dburl)
-    for x in Scorer.process(dbh):
-        x.process(dbh)
+    Scorer(policy = get_policy(args.policy), recompute_from = args.recompute_from, dry_run = args.dry_run).process(dbh)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+import datetime
+import itertools
+import sys
+import time
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.ScoreSimulator
+    __package__ = 'dmt.ScoreSimulator'
+
+import dmt.db as db
+import dmt.RunScorer as RunScorer
+
+HISTORY_COLUMNS = ('checkrun_id', 'checkrun_timestamp', 'site_id', 'error', 'age')
+
+def export_history(dbh, outfile):
+    """Write the checkoverview rows the score depends on to outfile as CSV, in the order they are scored.
+
+    The checkrun timestamp is in seconds since the epoch and the age in
+    seconds; an empty error means there was none.
+    """
+    cur = dbh.cursor()
+    cur.copy_expert("""
+        COPY (
+            SELECT
+                checkrun_id,
+                extract(epoch from checkrun_timestamp) AS checkrun_timestamp,
+                site_id,
+                error,
+                extract(epoch from age) AS age
+            FROM checkoverview
+            ORDER BY
+                checkrun_timestamp,
+                site_id
+        ) TO STDOUT WITH (FORMAT csv, HEADER)
+        """, outfile)
+
+class History():
+    """Checkoverview rows from export_history, in one batch per checkrun.
+
+    batches are (checkrun timestamp, whether the scorer ignores the
+    checkrun, rows), and rows are (site_id, error, age), as the scorer
+    gets them from the database.
+    """
+    def __init__(self, infile):
+        reader = csv.reader(infile)
+        header = next(reader)
+        if tuple(header) != HISTORY_COLUMNS:
+            raise ValueError("Unexpected history columns %s, want %s"%(', '.join(header), ', '.join(HISTORY_COLUMNS)))
+
+        self.batches = []
+        self.num_rows = 0
+        for ((_, checkrun_timestamp), rows) in itertools.groupby(reader, key=lambda r: (r[0], r[1])):
+            rows = [(int(site_id), error if error != '' else None, datetime.timedelta(seconds=float(age)) if age != '' else None)
+                    for (_, _, site_id, error, age) in rows]
+            errors = sum(1 for (_, error, _) in rows if error is not None)
+            ignore_this_run = len(rows) > 0 and float(errors)/len(rows) > RunScorer.IGNORE_RUN_THRESHOLD
+            self.batches.append((datetime.datetime.fromtimestamp(float(checkrun_timestamp), datetime.timezone.utc), ignore_this_run, rows))
+            self.num_rows += len(rows)
+        self.batches.sort(key=lambda batch: batch[0])
+
+    def replay(self, policy):
+        """Score the whole history with policy, from scratch.
+
+        Returns the scores, a list per batch in the order of its rows.
+        """
+        # site_id -> (score, checkrun timestamp) of its last checkrun
+        last = {}
+        scores = []
+        for (checkrun_timestamp, ignore_this_run, rows) in self.batches:
+            batch_scores = []
+            for (site_id, error, age) in rows:
+                prev = last.get(site_id)
+                if prev is None:
+                    score = policy.score(None, None, ignore_this_run, error, age)
+                else:
+                    score = policy.score(prev[0], (checkrun_timestamp - prev[1]).total_seconds(), ignore_this_run, error, age)
+                last[site_id] = (score, checkrun_timestamp)
+                batch_scores.append(score)
+            scores.append(batch_scores)
+        return scores
+
+def write_trajectories(outfile, history, names, results):
+    """Write the score of every site in every checkrun under each policy to outfile as CSV.
+    """
+    writer = csv.writer(outfile)
+    writer.writerow(['checkrun_timestamp', 'site_id'] + names)
+    for (n, (checkrun_timestamp, _, rows)) in enumerate(history.batches):
+        for (i, (site_id, _, _)) in enumerate(rows):
+            writer.writerow([checkrun_timestamp.isoformat(), site_id] + [scores[n][i] for scores in results])
+
+def report(history, names, results, timings):
+    """Print, per policy, what replaying took and where the sites ended up.
+    """
+    print("%d rows in %d checkruns"%(history.num_rows, len(history.batches)))
+    for (name, scores, seconds) in zip(names, results, timings):
+        final = {}
+        for ((_, _, rows), batch_scores) in zip(history.batches, scores):
+            for ((site_id, _, _), score) in zip(rows, batch_scores):
+                final[site_id] = score
+        below = sum(1 for score in final.values() if score < RunScorer.SCORE_CUTOFF)
+        mean = sum(final.values())/len(final) if len(final) > 0 else 0.0
+        per_10k = seconds * 10000 / history.num_rows if history.num_rows > 0 else 0.0
+        print("%s: %.3fs, %.2fms per 10k rows; final scores: mean %.1f, %d of %d sites below %.1f"%(
+            name, seconds, per_10k * 1000, mean, below, len(final), RunScorer.SCORE_CUTOFF))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay scoring policies over an export of checkoverview, without touching the database.')
+    parser.add_argument('--dburl', help='database', default=db.RawDB.DBURL)
+    parser.add_argument('--export', help='write the scoring history from the database to <file> and exit', metavar='FILE')
+    parser.add_argument('--history', help='replay the history in <file>, written by --export', metavar='FILE')
+    parser.add_argument('--policy', help='scoring policy to replay: one of %s, or module:attribute; may be given more than once'%(', '.join(sorted(RunScorer.POLICIES)),), action='append')
+    parser.add_argument('--repeat', help='replay each policy <x> times and report the fastest', type=int, default=1)
+    parser.add_argument('--trajectories', help='write the score of every site in every checkrun to <file>', metavar='FILE')
+    args = parser.parse_args()
+
+    if args.export is not None:
+        dbh = db.RawDB(args.dburl)
+        with open(args.export, 'w', encoding='utf-8') as f:
+            export_history(dbh, f)
+        return
+    if args.history is None:
+        parser.error('one of --export and --history is required')
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    names = args.policy if args.policy is not None else ['default']
+    policies = [RunScorer.get_policy(name) for name in names]
+    with open(args.history, encoding='utf-8', newline='') as f:
+        history = History(f)
+
+    results = []
+    timings = []
+    for policy in policies:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            scores = history.replay(policy)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append(scores)
+        timings.append(best)
+
+    report(history, names, results, timings)
+    if args.trajectories is not None:
+        with open(args.trajectories, 'w', encoding='utf-8', newline='') as f:
+            write_trajectories(f, history, names, results)
+
+if __name__ == "__main__":
+    main()
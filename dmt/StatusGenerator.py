@@ -26,9 +26,10 @@ class Generator():
         cur = dbh.cursor()
 
         now = datetime.datetime.now(datetime.timezone.utc)
-        ftpmastertrace = helpers.get_ftpmaster_trace(cur)
+        snapshot = helpers.get_run_snapshot(dbh)
+        ftpmastertrace = snapshot.ftpmastertrace
         if ftpmastertrace is None: ftpmastertrace = now
-        checkrun = helpers.get_latest_checkrun(cur)
+        checkrun = snapshot.checkrun
         if checkrun is None: return
 
         cur.execute("""
@@ -60,10 +61,20 @@ class Generator():
                 max_age.stddev AS max_age_stddev
 
             FROM site JOIN
-                checkoverview ON site.id = checkoverview.site_id LEFT OUTER JOIN
-                mastertrace ON site.id = mastertrace.site_id LEFT OUTER JOIN
-                sitetrace     ON site.id = sitetrace.site_id LEFT OUTER JOIN
-                traceset      ON site.id = traceset.site_id LEFT OUTER JOIN
+                checkoverview ON site.id = checkoverview.site_id LEFT OUTER JOIN LATERAL
+                (
+                 -- The checkrun in which the site was last actually checked.  Sites that
+                 -- were not due in an adaptive checkrun show their previous results.
+                 SELECT checkrun.id
+                 FROM checkrun
+                 WHERE checkrun.timestamp <= %(checkrun_timestamp)s AND
+                       NOT EXISTS (SELECT * FROM siteskip WHERE siteskip.site_id = site.id AND siteskip.checkrun_id = checkrun.id)
+                 ORDER BY checkrun.timestamp DESC
+                 LIMIT 1
+                ) AS datarun ON TRUE LEFT OUTER JOIN
+                mastertrace_run AS mastertrace ON site.id = mastertrace.site_id AND mastertrace.checkrun_id = datarun.id LEFT OUTER JOIN
+                sitetrace_run   AS sitetrace   ON site.id = sitetrace.site_id   AND sitetrace.checkrun_id   = datarun.id LEFT OUTER JOIN
+                traceset_run    AS traceset    ON site.id = traceset.site_id    AND traceset.checkrun_id    = datarun.id LEFT OUTER JOIN
                 (
                  SELECT num_runs / days AS runs_per_day,
                         site_id
@@ -71,9 +82,10 @@ class Generator():
                   SELECT COUNT(distinct trace_timestamp) AS num_runs,
                          EXTRACT(epoch from CURRENT_TIMESTAMP - MIN(checkrun.timestamp))/24/3600 AS days,
                          sitetrace.site_id
-                  FROM sitetrace JOIN
+                  FROM sitetrace_run AS sitetrace JOIN
                        checkrun ON sitetrace.checkrun_id = checkrun.id
                   WHERE sitetrace.trace_timestamp IS NOT NULL AND
+                        sitetrace.checkrun_timestamp > CURRENT_TIMESTAMP - INTERVAL '2 week' AND
                         checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '2 week'
                   GROUP BY sitetrace.site_id) AS sub
                 ) AS runs_per_day ON site.id = runs_per_day.site_id  LEFT OUTER JOIN
@@ -88,18 +100,18 @@ class Generator():
                                 CASE WHEN age > lead(age) OVER (PARTITION BY site_id ORDER BY checkrun.timestamp)
                                      THEN age END AS max_age
                                 FROM checkrun LEFT OUTER JOIN
-                                     checkoverview ON checkrun.id = checkoverview.checkrun_id
+                                     checkoverview ON checkrun.id = checkoverview.checkrun_id AND
+                                                   checkoverview.checkrun_timestamp > CURRENT_TIMESTAMP - INTERVAL '2 week'
                                 WHERE checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '2 week'
                         ) AS SUB
                           GROUP BY site_id
                  ) as max_age ON site.id = max_age.site_id
             WHERE
-                (checkoverview.checkrun_id = %(checkrun_id)s) AND
-                (mastertrace  .checkrun_id = %(checkrun_id)s OR mastertrace.checkrun_id IS NULL) AND
-                (sitetrace    .checkrun_id = %(checkrun_id)s OR sitetrace.checkrun_id IS NULL) AND
-                (traceset     .checkrun_id = %(checkrun_id)s OR traceset.checkrun_id IS NULL)
+                checkoverview.checkrun_id = %(checkrun_id)s AND
+                checkoverview.checkrun_timestamp = %(checkrun_timestamp)s
             """, {
-                'checkrun_id': checkrun['id']
+                'checkrun_id': checkrun['id'],
+                'checkrun_timestamp': checkrun['timestamp'],
             })
 
         mirrors = []
@@ -165,7 +177,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--dburl', help='database', default=db.RawDB.DBURL)
     parser.add_argument('--templatedir', help='template directory', default='templates')
-    parser.add_argument('--outfile', help='output-file', default=OUTFILE, type=argparse.FileType('w'))
+    parser.add_argument('--outfile', help='output-file', default=OUTFILE)
     args = parser.parse_args()
 
     base = BasePageRenderer(**args.__dict__)
@@ -24,7 +24,7 @@ class Generator():
         cur = dbh.cursor()
 
         now = datetime.datetime.now(datetime.timezone.utc)
-        checkrun = helpers.get_latest_checkrun(cur)
+        checkrun = helpers.get_run_snapshot(dbh).checkrun
         if checkrun is None: return
 
         cur.execute("""
@@ -41,11 +41,12 @@ class Generator():
                 sitetrace.content->'architectures-configuration'->>'text' AS arches
 
             FROM
-                sitetrace
+                sitetrace_run AS sitetrace
                 INNER JOIN site ON site.id = sitetrace.site_id
                 INNER JOIN checkrun ON checkrun.id = sitetrace.checkrun_id
             WHERE
-                checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '1 day'
+                sitetrace.checkrun_timestamp > CURRENT_TIMESTAMP - INTERVAL '1 day'
+                AND checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '1 day'
                 AND sitetrace.content IS NOT NULL
             ORDER BY site.id, checkrun.timestamp DESC
             """)
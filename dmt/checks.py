@@ -1,11 +1,14 @@
 #!/usr/bin/python3
 
+import asyncio
+import codecs
 from collections import OrderedDict
 #import dateutil.parser
 import datetime
-from bs4 import BeautifulSoup
+import html.parser
 import re
 import socket
+import sqlalchemy
 import sys
 import urllib
 import urllib.request
@@ -19,7 +22,9 @@ if __name__ == '__main__' and __package__ is None:
     __package__ = 'dmt.checks'
 
 import dmt.db as db
+import dmt.fetchers as fetchers
 import dmt.helpers as helpers
+import dmt.resolver as resolver
 
 class MirrorFailureException(Exception):
     def __init__(self, e, msg):
@@ -29,12 +34,39 @@ class MirrorFailureException(Exception):
             self.message = str(msg)
         self.origin = e
 
+def run_sync(coro):
+    """Run a check coroutine to completion on the calling thread.
+
+    This only works if the coroutine never suspends, which is the case
+    when its checks use a BlockingFetcher.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise Exception("check coroutine suspended; it needs to run in an event loop")
+
 class BaseCheck:
     TIMEOUT = 30
+    # no single fetch, redirects included, may take longer than this
+    DEADLINE = 20
+    # responses larger than this are an error
+    MAX_BYTES = 64*1024
+    # the db model our result is a row of
+    MODEL = None
+    # whoever runs the check may set this; run() makes a BlockingFetcher if they did not
+    fetcher = None
 
     def get_tracedir(self):
         return helpers.get_tracedir(self.site)
 
+    def host_key(self):
+        """The host this check connects to, as (hostname, port).
+        """
+        parts = urllib.parse.urlsplit(helpers.get_baseurl(self.site))
+        return (parts.hostname, parts.port)
+
     @staticmethod
     def _decode(b):
         try:
@@ -43,14 +75,28 @@ class BaseCheck:
             pass
         return b.decode('iso8859-1')
 
-    @staticmethod
-    def _fetch(url, request_headers={}):
+    async def _fetch(self, url, request_headers=None, sink=None):
+        (data, response) = await self._guarded(url,
+            self.fetcher.fetch(url, request_headers, max_bytes=self.MAX_BYTES, sink=sink, deadline=self.DEADLINE))
+        if response.truncated:
+            raise MirrorFailureException(None, 'response larger than %d bytes fetching %s'%(self.MAX_BYTES, url))
+        return (data, response)
+
+    async def _probe(self, url, request_headers=None):
+        """Get only the response headers for url.
+        """
+        return await self._guarded(url, self.fetcher.probe(url, request_headers, deadline=self.DEADLINE))
+
+    async def _guarded(self, url, aw):
+        """Await aw, turning whatever goes wrong fetching url into a MirrorFailureException.
+        """
         try:
-            req = urllib.request.Request(url, headers=request_headers)
-            with urllib.request.urlopen(req, timeout=BaseCheck.TIMEOUT) as response:
-                data = response.read()
-                return (data, response)
-        except socket.timeout as e:
+            return await aw
+        except resolver.ResolveError as e:
+            raise MirrorFailureException(e, str(e))
+        except fetchers.DeadlineExceeded as e:
+            raise MirrorFailureException(e, 'took longer than %d seconds fetching %s'%(self.DEADLINE, url))
+        except (socket.timeout, asyncio.TimeoutError) as e:
             raise MirrorFailureException(e, 'timed out fetching '+url)
         except urllib.error.URLError as e:
             raise MirrorFailureException(e, e.reason)
@@ -60,23 +106,40 @@ class BaseCheck:
             raise MirrorFailureException(e, 'other exception: '+str(e))
 
     def __init__(self, site, checkrun_id):
-        self.site      = site.__dict__
+        # a copy, as committing expires the attributes of site
+        self.site      = dict(site.__dict__)
         self.result = {
             'site_id':     site.id,
             'checkrun_id': checkrun_id
         }
 
     def run(self):
-        raise Exception("run called on abstractish base class")
+        if self.fetcher is None:
+            self.fetcher = fetchers.BlockingFetcher(timeout=self.TIMEOUT)
+        run_sync(self.arun())
+
+    async def arun(self):
+        raise Exception("arun called on abstractish base class")
 
-    def store(self, session, checkrun_id):
-        raise Exception("store called on abstractish base class")
+    def blobs(self):
+        """Trace contents our result refers to, as a dict of digest -> contents.
+        """
+        return {}
 
 
 class TracefileFetcher(BaseCheck):
-    def __init__(self, site, checkrun_id, tracefilename, request_host=None):
+    # What we carry forward from the previous result if the tracefile did not change
+    CARRIED_FIELDS = ('full_digest', 'trace_timestamp', 'content', 'http_etag', 'http_last_modified')
+
+    def __init__(self, site, checkrun_id, tracefilename, request_host=None, previous=None):
+        """previous, if given, is a dict of CARRIED_FIELDS from the last good
+           result for this tracefile.  Its validators are used to make the
+           request conditional.
+        """
         super().__init__(site, checkrun_id)
         self.tracefilename = tracefilename
+        self.previous = previous
+        self.full = None
         self.request_headers = {}
         if request_host is not None:
             self.request_headers['Host'] = request_host
@@ -84,7 +147,8 @@ class TracefileFetcher(BaseCheck):
     def parse_tracefile(self, rawcontents):
         try:
             decoded = self._decode(rawcontents)
-            self.result['full'] = decoded
+            self.full = decoded
+            self.result['full_digest'] = helpers.get_trace_digest(decoded)
             content = {}
 
             lines = decoded.split('\n')
@@ -113,38 +177,65 @@ class TracefileFetcher(BaseCheck):
         except:
             self.result['error'] = "Invalid tracefile"
 
-    def run(self):
+    def _conditional_headers(self):
+        headers = dict(self.request_headers)
+        if self.previous is not None:
+            if self.previous['http_etag'] is not None:
+                headers['If-None-Match'] = self.previous['http_etag']
+            if self.previous['http_last_modified'] is not None:
+                headers['If-Modified-Since'] = self.previous['http_last_modified']
+        return headers
+
+    def _store_validators(self, headers, fallback=None):
+        if fallback is None:
+            fallback = {}
+        self.result['http_etag'] = headers.get('ETag', fallback.get('http_etag'))
+        self.result['http_last_modified'] = headers.get('Last-Modified', fallback.get('http_last_modified'))
+
+    def blobs(self):
+        if self.full is None:
+            return {}
+        return {self.result['full_digest']: self.full}
+
+    async def arun(self):
         try:
             traceurl = urllib.parse.urljoin(self.get_tracedir(), self.tracefilename)
-            (rawtracefilecontents, _) = self._fetch(traceurl, request_headers=self.request_headers)
+            (rawtracefilecontents, response) = await self._fetch(traceurl, request_headers=self._conditional_headers())
             self.parse_tracefile(rawtracefilecontents)
+            self._store_validators(response.headers)
         except MirrorFailureException as e:
-            self.result['error'] = e.message
+            if self.previous is not None and isinstance(e.origin, urllib.error.HTTPError) and e.origin.code == 304:
+                # Not modified: same contents as last time, no need to parse again.
+                for field in self.CARRIED_FIELDS:
+                    self.result[field] = self.previous[field]
+                self._store_validators(e.origin.headers, self.previous)
+            else:
+                self.result['error'] = e.message
 
 class MastertraceFetcher(TracefileFetcher):
-    def __init__(self, site, checkrun_id):
-        super().__init__(site, checkrun_id, 'master')
+    MODEL = db.Mastertrace
 
-    def store(self, session, checkrun_id):
-        i = db.Mastertrace(**self.result)
-        session.add(i)
+    def __init__(self, site, checkrun_id, previous=None):
+        super().__init__(site, checkrun_id, 'master', previous=previous)
 
 class SitetraceFetcher(TracefileFetcher):
-    def __init__(self, site, checkrun_id):
-        super().__init__(site, checkrun_id, site.name)
+    MODEL = db.Sitetrace
 
-    def run(self):
-        super().run()
+    def __init__(self, site, checkrun_id, previous=None):
+        super().__init__(site, checkrun_id, site.name, previous=previous)
+
+    async def arun(self):
+        await super().arun()
         if 'error' in self.result: return
 
         base = helpers.get_baseurl(self.site)
         errors = []
         for key in ('Archive-Update-in-Progress', 'Archive-Update-Required'):
             url = base + key + '-' + self.site['name']
-            req = urllib.request.Request(url)
             lm = None
             try:
-                (_, response) = self._fetch(url)
+                # We only need the Last-Modified, not the file.
+                response = await self._probe(url)
                 lm = response.getheader('Last-Modified')
             except MirrorFailureException as e:
                 if isinstance(e.origin, urllib.error.HTTPError) and (e.origin.code == 404 or e.origin.code == 403):
@@ -159,26 +250,70 @@ class SitetraceFetcher(TracefileFetcher):
         if len(errors) > 0:
             self.result['error'] = '; '.join(errors)
 
-    def store(self, session, checkrun_id):
-        i = db.Sitetrace(**self.result)
-        session.add(i)
-
 class SiteAliasFetcher(TracefileFetcher):
-    def __init__(self, site, checkrun_id, sitealias):
+    MODEL = db.SiteAliasMastertrace
+
+    def __init__(self, site, checkrun_id, sitealias, previous=None):
         #self.sitealias = sitealias
-        super().__init__(site, checkrun_id, 'master', request_host=sitealias.name)
+        super().__init__(site, checkrun_id, 'master', request_host=sitealias.name, previous=previous)
         del self.result['site_id']
         self.result['sitealias_id'] = sitealias.id
 
-    def store(self, session, checkrun_id):
-        i = db.SiteAliasMastertrace(**self.result)
-        session.add(i)
-
-def siteAliasChecker_generator(site, checkrun_id):
+def siteAliasChecker_generator(site, checkrun_id, previous=None):
+    if previous is None:
+        previous = {}
     for alias in site.sitealiases:
-        yield SiteAliasFetcher(site, checkrun_id, alias)
+        yield SiteAliasFetcher(site, checkrun_id, alias, previous=previous.get(alias.id))
+
+def get_previous_traces(session, model, key):
+    """For each site (or alias, depending on key), get the most recent tracefile
+       result of type model that has HTTP validators and no error.
+
+       Returns a dict of key -> dict of TracefileFetcher.CARRIED_FIELDS.
+    """
+    keycolumn = getattr(model, key)
+    query = session.query(model). \
+        join(db.Checkrun, model.last_checkrun_id == db.Checkrun.id). \
+        filter(model.error == None). \
+        filter(sqlalchemy.or_(model.http_etag != None, model.http_last_modified != None)). \
+        order_by(keycolumn, db.Checkrun.timestamp.desc()). \
+        distinct(keycolumn)
+    res = {}
+    for row in query:
+        res[getattr(row, key)] = {field: getattr(row, field) for field in TracefileFetcher.CARRIED_FIELDS}
+    return res
+
+class HrefExtractor(html.parser.HTMLParser):
+    """Collect the href of every <a> tag of an HTML page fed in as bytes.
+
+    Pages are decoded as UTF-8, with anything undecodable replaced; links
+    we are interested in are plain ASCII anyway.
+    """
+    def __init__(self):
+        super().__init__()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.hrefs = []
+
+    def feed_bytes(self, data):
+        self.feed(self.decoder.decode(data))
+
+    def close(self):
+        self.feed(self.decoder.decode(b'', final=True))
+        super().close()
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        # like BeautifulSoup: the last of repeated attributes wins, and one without a value is empty
+        href = dict(attrs).get('href', False)
+        if href is not False:
+            self.hrefs.append(href or '')
 
 class TracesetFetcher(BaseCheck):
+    MODEL = db.Traceset
+    # directory listings of big mirrors' trace directories are not small
+    MAX_BYTES = 1024*1024
+
     def __init__(self, site, checkrun_id):
         super().__init__(site, checkrun_id)
 
@@ -211,21 +346,20 @@ class TracesetFetcher(BaseCheck):
         else:
             return None
 
-    def list_tracefiles(self):
+    async def list_tracefiles(self):
         tracedir = self.get_tracedir()
-        (data, _) = self._fetch(tracedir)
+        extractor = HrefExtractor()
+        await self._fetch(tracedir, sink=extractor.feed_bytes)
+        extractor.close()
 
-        soup = BeautifulSoup(data, "html.parser")
-        links = soup.find_all('a')
-        links = filter(lambda x: 'href' in x.attrs, links)
-        links = map(lambda x: self._clean_link(x.get('href'), tracedir), links)
+        links = map(lambda x: self._clean_link(x, tracedir), extractor.hrefs)
         tracefiles = filter(lambda x: x is not None, links)
         tracefiles = self._filter_tracefilenames(tracefiles)
         return sorted(set(tracefiles))
 
-    def run(self):
+    async def arun(self):
         try:
-            traces = self.list_tracefiles()
+            traces = await self.list_tracefiles()
 
             if len(traces) > 0:
                 self.result['traceset'] = traces
@@ -233,7 +367,3 @@ class TracesetFetcher(BaseCheck):
                 self.result['error'] = "No traces found"
         except MirrorFailureException as e:
             self.result['error'] = e.message
-
-    def store(self, session, checkrun_id):
-        i = db.Traceset(**self.result)
-        session.add(i)
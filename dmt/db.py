@@ -1,12 +1,15 @@
 #!/usr/bin/python3
 
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Interval, Float
+import contextlib
+import datetime
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Interval, Float, Boolean
 from sqlalchemy.dialects.postgresql import JSONB
 import sqlalchemy
 from sqlalchemy.orm import relationship, backref
 import sqlalchemy.ext.declarative
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 
 Base = sqlalchemy.ext.declarative.declarative_base()
 
@@ -47,29 +50,61 @@ class SiteAlias(Base):
 
 class Checkrun(Base):
     """Instance of a mirror check run
+
+       Results are committed as they come in, so until completed is set,
+       once all checks are done, a checkrun's results are not all there.
     """
     __tablename__           = 'checkrun'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = {'postgresql_partition_by': 'RANGE (timestamp)'}
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
+    timestamp               = Column(DateTime(timezone=True), primary_key=True, index=True)
+    completed               = Column(Boolean, nullable=False, default=False, server_default=sqlalchemy.false())
+
+
+class Traceblob(Base):
+    """Full contents of a tracefile, stored once no matter how many
+       checks saw it.  Keyed by the hex sha256 of the contents.
+    """
+    __tablename__           = 'traceblob'
+    digest                  = Column(String, primary_key=True)
 
-    timestamp               = Column(DateTime(timezone=True), index=True)
+    full                    = Column(String, nullable=False)
 
 
+# checkrun and the tables that hold its results are partitioned by day on
+# the time of the checkrun, so pruning old checkruns drops whole partitions
+# (see create_partitions and prune_checkruns).  Foreign keys to checkrun do not
+# work with that, so the results carry checkrun_timestamp along with their
+# checkrun_id, which also lets filters on it skip partitions.
+PARTITIONED_TABLES = ('mastertrace', 'sitetrace', 'traceset', 'sitealiasmastertrace', 'checkoverview', 'siteskip', 'checkrun')
+
+# A check result that is the same as in the previous checkrun is not stored
+# again; instead the row of the previous one gets extended.  So each row of
+# the tables below covers all checkruns from checkrun_id to last_checkrun_id.
+# The <table>_run views expand them back into one row per checkrun.
+INTERVAL_TABLES = ('mastertrace', 'sitetrace', 'traceset', 'sitealiasmastertrace')
+
 class Mastertrace(Base):
     """Age of the master tracefile
     """
     __tablename__           = 'mastertrace'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = {'postgresql_partition_by': 'RANGE (checkrun_timestamp)'}
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
-    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, nullable=False, index=True)
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_id        = Column(Integer, nullable=False, index=True)
     site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
-    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", primaryjoin="Checkrun.id == foreign(Mastertrace.checkrun_id)", backref=__plural__)
 
-    full                    = Column(String, index=True)
+    full_digest             = Column(String, ForeignKey("traceblob.digest"), index=True)
     trace_timestamp         = Column(DateTime(timezone=True))
     error                   = Column(String)
     content                 = Column(JSONB(none_as_null=True))
+    http_etag               = Column(String)
+    http_last_modified      = Column(String)
 
 
 class Sitetrace(Base):
@@ -77,20 +112,25 @@ class Sitetrace(Base):
     """
     __tablename__           = 'sitetrace'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = {'postgresql_partition_by': 'RANGE (checkrun_timestamp)'}
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
-    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, nullable=False, index=True)
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_id        = Column(Integer, nullable=False, index=True)
     site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
-    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", primaryjoin="Checkrun.id == foreign(Sitetrace.checkrun_id)", backref=__plural__)
 
     archive_update_in_progress = Column(DateTime(timezone=True))
     archive_update_required    = Column(DateTime(timezone=True))
 
-    full                    = Column(String, index=True)
+    full_digest             = Column(String, ForeignKey("traceblob.digest"), index=True)
     trace_timestamp         = Column(DateTime(timezone=True), index=True)
     error                   = Column(String)
     content                 = Column(JSONB(none_as_null=True))
+    http_etag               = Column(String)
+    http_last_modified      = Column(String)
 
 
 class Traceset(Base):
@@ -98,12 +138,15 @@ class Traceset(Base):
     """
     __tablename__           = 'traceset'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = {'postgresql_partition_by': 'RANGE (checkrun_timestamp)'}
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
-    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, nullable=False, index=True)
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_id        = Column(Integer, nullable=False, index=True)
     site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
-    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", primaryjoin="Checkrun.id == foreign(Traceset.checkrun_id)", backref=__plural__)
 
     traceset                = Column(JSONB(none_as_null=True))
     error                   = Column(String)
@@ -113,17 +156,38 @@ class SiteAliasMastertrace(Base):
     """
     __tablename__           = 'sitealiasmastertrace'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = {'postgresql_partition_by': 'RANGE (checkrun_timestamp)'}
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     sitealias_id            = Column(Integer, ForeignKey("sitealias.id", ondelete='CASCADE'), nullable=False, index=True)
-    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, nullable=False, index=True)
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_id        = Column(Integer, nullable=False, index=True)
     sitealias               = relationship("SiteAlias", backref=backref(__plural__, passive_deletes=True))
-    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", primaryjoin="Checkrun.id == foreign(SiteAliasMastertrace.checkrun_id)", backref=__plural__)
 
-    full                    = Column(String)
+    full_digest             = Column(String, ForeignKey("traceblob.digest"), index=True)
     trace_timestamp         = Column(DateTime(timezone=True))
     error                   = Column(String)
     content                 = Column(JSONB(none_as_null=True))
+    http_etag               = Column(String)
+    http_last_modified      = Column(String)
+
+class Siteskip(Base):
+    """Site that was not due for checking in an adaptive checkrun.
+
+    Its previous results are carried forward for this checkrun.
+    """
+    __tablename__           = 'siteskip'
+    __plural__              = __tablename__ + 's'
+    __table_args__          = {'postgresql_partition_by': 'RANGE (checkrun_timestamp)'}
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
+
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, nullable=False, index=True)
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", primaryjoin="Checkrun.id == foreign(Siteskip.checkrun_id)", backref=__plural__)
 
 class Checkoverview(Base):
     """For a mirror and a check, summarize all we learned from a test-run.
@@ -133,12 +197,14 @@ class Checkoverview(Base):
     """
     __tablename__           = 'checkoverview'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = {'postgresql_partition_by': 'RANGE (checkrun_timestamp)'}
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
-    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, nullable=False, index=True)
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
     site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
-    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", primaryjoin="Checkrun.id == foreign(Checkoverview.checkrun_id)", backref=__plural__)
 
     error                   = Column(String)
     version                 = Column(DateTime(timezone=True))
@@ -146,6 +212,32 @@ class Checkoverview(Base):
     score                   = Column(Float)
     aliases                 = Column(JSONB(none_as_null=True))
 
+class SitetraceVersion(Base):
+    """The master tracefile a site had when its tracefile got a timestamp,
+       i.e. the version of the archive it synced then.
+
+    Taken from the earliest checkrun that saw both, and filled in as
+    checkruns get processed.
+    """
+    __tablename__           = 'sitetraceversion'
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), primary_key=True)
+    sitetrace_trace_timestamp = Column(DateTime(timezone=True), primary_key=True)
+    site                    = relationship("Site", backref=backref("sitetraceversions", passive_deletes=True))
+
+    mastertrace_trace_timestamp = Column(DateTime(timezone=True), nullable=False)
+
+class Ftpmastertrace(Base):
+    """A trace timestamp ftp-master had, and the first and last checkrun in
+       which we saw it there.
+
+    Kept up to date as check results get stored.
+    """
+    __tablename__           = 'ftpmastertrace'
+    trace_timestamp         = Column(DateTime(timezone=True), primary_key=True)
+
+    first_seen              = Column(DateTime(timezone=True), nullable=False)
+    last_seen               = Column(DateTime(timezone=True), nullable=False)
+
 class MirrorDB():
     DBURL = 'postgresql:///mirror-status'
     def __init__(self, dburl=DBURL):
@@ -158,15 +250,146 @@ class MirrorDB():
 
 class RawDB():
     DBURL = MirrorDB.DBURL
-    def __init__(self, dburl=DBURL):
-        self.conn = psycopg2.connect(dburl)
-
-    def cursor(self):
-        c = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    def __init__(self, dburl=DBURL, conn=None, lazy=False):
+        """Connect to dburl, unless given conn; with lazy, only once a cursor is first asked for.
+        """
+        self.dburl = dburl
+        self.conn = conn
+        if self.conn is None and not lazy:
+            self.conn = psycopg2.connect(dburl)
+
+    def cursor(self, name=None):
+        """A cursor returning rows as dicts; a server-side one, fetching rows as they are needed, if named.
+        """
+        if self.conn is None:
+            self.conn = psycopg2.connect(self.dburl)
+        c = self.conn.cursor(name=name, cursor_factory=psycopg2.extras.RealDictCursor)
         return c
 
     def commit(self):
-       self.conn.commit()
+        if self.conn is not None:
+            self.conn.commit()
+
+    def rollback(self):
+        if self.conn is not None:
+            self.conn.rollback()
+
+class RawDBPool():
+    """A bounded pool of database connections, to be shared by threads.
+
+    connection() hands out one of at most maxconn connections as a RawDB,
+    and takes it back, rolling back whatever was not committed, when done.
+    """
+    def __init__(self, dburl=RawDB.DBURL, maxconn=1):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, dburl)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.pool.getconn()
+        try:
+            yield RawDB(conn=conn)
+        finally:
+            conn.rollback()
+            self.pool.putconn(conn)
+
+    def close(self):
+        self.pool.closeall()
+
+def _day(session, timestamp):
+    """The start of the UTC day of timestamp, and that day as YYYYMMDD, the suffix of its partitions.
+    """
+    return session.execute(sqlalchemy.text("""
+        SELECT day AT TIME ZONE 'UTC', to_char(day, 'YYYYMMDD')
+        FROM (SELECT date_trunc('day', CAST(:timestamp AS timestamptz) AT TIME ZONE 'UTC') AS day) AS d
+        """), {
+            'timestamp': timestamp,
+        }).first()
+
+def create_partitions(session, timestamp):
+    """Create the partitions of PARTITIONED_TABLES for the day of timestamp, unless they exist
+    """
+    (day, suffix) = _day(session, timestamp)
+    for table in PARTITIONED_TABLES:
+        session.execute(sqlalchemy.text("""
+            CREATE TABLE IF NOT EXISTS %(table)s_p%(suffix)s PARTITION OF %(table)s
+            FOR VALUES FROM ('%(start)s') TO ('%(end)s')
+            """ % {
+                'table': table,
+                'suffix': suffix,
+                'start': day.isoformat(' '),
+                'end': (day + datetime.timedelta(days=1)).isoformat(' '),
+            }))
+
+def prune_checkruns(session, cutoff):
+    """Delete checkruns from before the day of cutoff, and all their results
+
+    This drops the partitions of those days.  Rows of INTERVAL_TABLES that
+    also cover later checkruns are kept, and moved to start at the first of
+    those.
+    """
+    (day, suffix) = _day(session, cutoff)
+    first = session.query(Checkrun).filter(Checkrun.timestamp >= day).order_by(Checkrun.timestamp).first()
+    if first is not None:
+        create_partitions(session, first.timestamp)
+        for table in INTERVAL_TABLES:
+            session.execute(sqlalchemy.text("""
+                UPDATE %(table)s AS span
+                SET checkrun_id = :first_id, checkrun_timestamp = :first_timestamp
+                FROM checkrun AS last_checkrun
+                WHERE
+                    span.checkrun_timestamp < :day AND
+                    last_checkrun.id = span.last_checkrun_id AND
+                    last_checkrun.timestamp >= :day
+                """ % {
+                    'table': table,
+                }), {
+                    'first_id': first.id,
+                    'first_timestamp': first.timestamp,
+                    'day': day,
+                })
+    for table in PARTITIONED_TABLES:
+        partitions = session.execute(sqlalchemy.text("""
+            SELECT partition.relname
+            FROM pg_inherits JOIN
+                pg_class AS partition ON partition.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = CAST(:table AS regclass)
+            """), {
+                'table': table,
+            }).fetchall()
+        for (partition,) in partitions:
+            if partition[len(table + '_p'):] < suffix:
+                session.execute(sqlalchemy.text("DROP TABLE %s" % (partition,)))
+
+def prune_traceblobs(session):
+    """Delete trace contents no check refers to any longer
+    """
+    session.execute(sqlalchemy.text("""
+        DELETE FROM traceblob
+        WHERE
+            NOT EXISTS (SELECT 1 FROM mastertrace          WHERE full_digest = traceblob.digest) AND
+            NOT EXISTS (SELECT 1 FROM sitetrace            WHERE full_digest = traceblob.digest) AND
+            NOT EXISTS (SELECT 1 FROM sitealiasmastertrace WHERE full_digest = traceblob.digest)
+        """))
+
+def prune_sitetraceversions(session):
+    """Delete versions of sitetrace timestamps no check refers to any longer
+    """
+    session.execute(sqlalchemy.text("""
+        DELETE FROM sitetraceversion
+        WHERE
+            NOT EXISTS (SELECT 1 FROM sitetrace
+                        WHERE sitetrace.site_id = sitetraceversion.site_id AND
+                              sitetrace.trace_timestamp = sitetraceversion.sitetrace_trace_timestamp)
+        """))
+
+def prune_ftpmastertraces(session):
+    """Forget ftp-master trace timestamps not seen in any checkrun we still have
+    """
+    session.execute(sqlalchemy.text("""
+        DELETE FROM ftpmastertrace
+        WHERE
+            last_seen < (SELECT min(timestamp) FROM checkrun)
+        """))
 
 def update_or_create(session, model, updates, **kwargs):
     r = session.query(model).filter_by(**kwargs)
@@ -0,0 +1,559 @@
+#!/usr/bin/python3
+
+import asyncio
+import base64
+import email.parser
+import http.client
+import socket
+import ssl
+import sys
+import threading
+import time
+import urllib
+import urllib.error
+import urllib.parse
+import urllib.request
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.fetchers
+    __package__ = 'dmt.fetchers'
+
+import dmt.resolver
+
+# Same defaults urllib uses, so mirrors see the same kind of client
+# no matter which engine ran the checks.
+USER_AGENT = 'Python-urllib/%s' % (urllib.request.__version__,)
+MAX_REDIRECTS = urllib.request.HTTPRedirectHandler.max_redirections
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+MAX_HEADERS = 100
+READ_SIZE = 64*1024
+# responses to HEAD that mean the server does not do HEAD
+HEAD_REJECTED_CODES = (405, 501)
+
+
+class DeadlineExceeded(socket.timeout):
+    """A fetch took longer than its deadline.
+    """
+
+class Response:
+    """The parts of an HTTP response the checks care about.
+
+    Offers the same getheader() as http.client.HTTPResponse.  truncated is
+    set if we stopped reading the body before its end.
+    """
+    def __init__(self, url, status, reason, headers, truncated=False):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.truncated = truncated
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        headers = self.headers.get_all(name) or default
+        if isinstance(headers, str) or not hasattr(headers, '__iter__'):
+            return headers
+        return ', '.join(headers)
+
+
+class _Body:
+    """Collects a response body, or up to max_bytes of it.
+
+    If sink is given, chunks are passed to it as they arrive instead of
+    being kept.
+    """
+    def __init__(self, max_bytes=None, sink=None):
+        self.remaining = max_bytes
+        self.sink = sink
+        self.chunks = []
+        self.truncated = False
+
+    def next_read_size(self):
+        """How much to read next: one byte over the limit tells us if there is more.
+        """
+        if self.remaining is None:
+            return READ_SIZE
+        return min(READ_SIZE, self.remaining + 1)
+
+    def add(self, chunk):
+        if self.remaining is not None:
+            if len(chunk) > self.remaining:
+                chunk = chunk[:self.remaining]
+                self.truncated = True
+            self.remaining -= len(chunk)
+        if len(chunk) == 0:
+            return
+        if self.sink is None:
+            self.chunks.append(chunk)
+        else:
+            self.sink(chunk)
+
+    def data(self):
+        return b''.join(self.chunks)
+
+
+class BaseFetcher:
+    """Common behaviour of all fetchers.
+
+    Connections are kept alive and pooled by (scheme, host, port), so
+    all checks of a site that share a fetcher also share connections to that
+    site.  Fetching behaves like urllib as far as the checks can tell:
+    redirects are followed, and responses that are not 2xx raise
+    urllib.error.HTTPError.
+
+    Hostnames are looked up through a dmt.resolver.Resolver, and we connect to
+    the addresses it returns, while still sending the hostname in the Host
+    header and for TLS.
+    """
+    # idle connections kept per (scheme, host, port)
+    MAX_IDLE_PER_HOST = 8
+
+    def __init__(self, timeout, resolver=None):
+        self.timeout = timeout
+        self.sslcontext = ssl.create_default_context()
+        self.idle = {}
+        if resolver is None:
+            resolver = dmt.resolver.Resolver()
+        self.resolver = resolver
+
+    async def fetch(self, url, request_headers=None, method='GET', max_bytes=None, sink=None, deadline=None):
+        """Fetch url, returning the body and the Response.
+
+        If max_bytes is given, read no more than that many bytes of the body.
+        If sink is given, the body of a successful response is passed to it
+        chunk by chunk as it comes in, and the returned body is empty.
+        If deadline is given, the whole fetch including redirects may take
+        no more than that many seconds, or DeadlineExceeded is raised.
+        """
+        expires = None if deadline is None else time.monotonic() + deadline
+        for _ in range(MAX_REDIRECTS + 1):
+            (data, response) = await self._request(url, request_headers, method, max_bytes, sink, expires)
+            location = response.getheader('Location')
+            if response.status in REDIRECT_CODES and location is not None:
+                newurl = urllib.parse.urljoin(url, location)
+                if urllib.parse.urlsplit(newurl).scheme not in DEFAULT_PORTS:
+                    raise urllib.error.HTTPError(newurl, response.status,
+                        "redirection to url '%s' is not allowed"%(newurl,), response.headers, None)
+                url = newurl
+                continue
+            if not 200 <= response.status < 300:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return (data, response)
+        raise urllib.error.HTTPError(url, response.status,
+            urllib.request.HTTPRedirectHandler.inf_msg + response.reason, response.headers, None)
+
+    async def probe(self, url, request_headers=None, deadline=None):
+        """Fetch only the headers of url, returning the Response.
+
+        Uses a HEAD request.  Servers that reject HEAD get a GET instead,
+        of which we read none of the body.
+        """
+        try:
+            (_, response) = await self.fetch(url, request_headers, method='HEAD', deadline=deadline)
+            return response
+        except urllib.error.HTTPError as e:
+            if e.code not in HEAD_REJECTED_CODES:
+                raise
+        (_, response) = await self.fetch(url, request_headers, max_bytes=0, deadline=deadline)
+        return response
+
+    async def _request(self, url, request_headers, method, max_bytes, sink, expires):
+        """Make a single request, without following redirects, returning the body and the Response.
+        """
+        raise Exception("_request called on abstractish base class")
+
+    @staticmethod
+    def _remaining(expires):
+        """Seconds left until expires, or None if there is no deadline.
+        """
+        if expires is None:
+            return None
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded('deadline exceeded')
+        return remaining
+
+    @staticmethod
+    def _prepare(url, request_headers):
+        """Split url into the pool key, the request target and the headers to send.
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in DEFAULT_PORTS:
+            raise urllib.error.URLError('unknown url type: %s'%(parts.scheme,))
+        if not parts.hostname:
+            raise urllib.error.URLError('no host given')
+        key = (parts.scheme, parts.hostname, parts.port or DEFAULT_PORTS[parts.scheme])
+
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+
+        headers = {
+            'Host': parts.netloc.rpartition('@')[2],
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'identity',
+        }
+        if request_headers is not None:
+            for k, value in request_headers.items():
+                headers[k.capitalize()] = value
+        return (key, selector, headers)
+
+    @staticmethod
+    def _body(status, max_bytes, sink):
+        # only what the caller asked for goes to the sink, not redirects or errors
+        if not 200 <= status < 300:
+            sink = None
+        return _Body(max_bytes, sink)
+
+    def _checkout(self, key):
+        """Return an idle connection to key, or None.
+        """
+        conns = self.idle.get(key)
+        if conns:
+            return conns.pop()
+        return None
+
+    def _checkin(self, key, conn):
+        """Return conn to the pool.  Returns False if the pool for key is full.
+        """
+        conns = self.idle.setdefault(key, [])
+        if len(conns) >= self.MAX_IDLE_PER_HOST:
+            return False
+        conns.append(conn)
+        return True
+
+
+def _create_connection(resolver, address, timeout, source_address=None):
+    """Like socket.create_connection, but looking up the host with resolver.
+    """
+    (host, port) = address
+    error = None
+    for (_, addr) in resolver.lookup(host):
+        try:
+            return socket.create_connection((addr, port), timeout, source_address)
+        except OSError as e:
+            error = e
+    raise error
+
+class _HTTPConnection(http.client.HTTPConnection):
+    """An HTTPConnection that connects to the addresses resolver has for its host.
+    """
+    def __init__(self, *args, resolver=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.resolver = resolver
+
+    def connect(self):
+        self.sock = _create_connection(self.resolver, (self.host, self.port), self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class _HTTPSConnection(http.client.HTTPSConnection, _HTTPConnection):
+    """An HTTPSConnection that connects to the addresses resolver has for its host.
+
+    HTTPSConnection.connect() wraps what _HTTPConnection.connect() connected.
+    """
+    def __init__(self, *args, resolver=None, **kwargs):
+        # HTTPSConnection passes on to _HTTPConnection without a resolver
+        super().__init__(*args, **kwargs)
+        self.resolver = resolver
+
+
+class BlockingFetcher(BaseFetcher):
+    """Fetch URLs using http.client, blocking the calling thread.
+
+    fetch() is a coroutine only so that checks can share their code with the
+    asyncio engine; it never suspends, so checks driving it can be run to
+    completion without an event loop (see checks.run_sync).
+
+    Like urllib, requests go through the proxies urllib.request.getproxies()
+    finds, such as http_proxy and https_proxy from the environment, except
+    for hosts that no_proxy exempts.  We leave looking up the names of
+    proxied hosts to the proxy.
+    """
+    def __init__(self, timeout, resolver=None):
+        super().__init__(timeout, resolver)
+        self.lock = threading.Lock()
+        self.proxies = urllib.request.getproxies()
+
+    def _proxy(self, key):
+        """The proxy to use for key, as (host, port, headers to send it), or None to connect directly.
+        """
+        (scheme, host, _) = key
+        proxy = self.proxies.get(scheme)
+        if proxy is None or urllib.request.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urllib.parse.urlsplit(proxy)
+        headers = {}
+        if parts.username is not None:
+            credentials = '%s:%s'%(urllib.parse.unquote(parts.username), urllib.parse.unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        return (parts.hostname, parts.port or DEFAULT_PORTS['http'], headers)
+
+    def _connect(self, key):
+        (scheme, host, port) = key
+        proxy = self._proxy(key)
+        if proxy is not None:
+            (proxy_host, proxy_port, proxy_headers) = proxy
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=self.timeout, context=self.sslcontext)
+                conn.set_tunnel(host, port, headers=proxy_headers)
+                return conn
+            return http.client.HTTPConnection(proxy_host, proxy_port, timeout=self.timeout)
+        if scheme == 'https':
+            return _HTTPSConnection(host, port, resolver=self.resolver, timeout=self.timeout, context=self.sslcontext)
+        return _HTTPConnection(host, port, resolver=self.resolver, timeout=self.timeout)
+
+    def _timeout(self, expires):
+        remaining = self._remaining(expires)
+        if remaining is None:
+            return self.timeout
+        return min(self.timeout, remaining)
+
+    def _send(self, conn, method, selector, headers, expires):
+        """Send the request and read the response head.
+
+        Returns the response and the socket it is read from, which stays
+        usable for reading the body even if conn closes it.
+        """
+        conn.timeout = self._timeout(expires)
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+        conn.request(method, selector, headers=headers)
+        sock = conn.sock
+        sock.settimeout(self._timeout(expires))
+        return (conn.getresponse(), sock)
+
+    async def _request(self, url, request_headers, method, max_bytes, sink, expires):
+        (key, selector, headers) = self._prepare(url, request_headers)
+        proxy = self._proxy(key)
+        if proxy is not None and key[0] == 'http':
+            # plain HTTP proxies want the whole URL
+            selector = '%s://%s%s'%(key[0], headers['Host'], selector)
+            headers.update(proxy[2])
+        with self.lock:
+            conn = self._checkout(key)
+        reused = conn is not None
+        if not reused:
+            conn = self._connect(key)
+
+        try:
+            try:
+                (response, sock) = self._send(conn, method, selector, headers, expires)
+            except (ConnectionResetError, BrokenPipeError):
+                # The server closed an idle keep-alive connection on us.
+                if not reused: raise
+                conn.close()
+                conn = self._connect(key)
+                (response, sock) = self._send(conn, method, selector, headers, expires)
+            body = self._body(response.status, max_bytes, sink)
+            while not body.truncated:
+                sock.settimeout(self._timeout(expires))
+                chunk = response.read1(body.next_read_size())
+                if not chunk: break
+                body.add(chunk)
+            if not body.truncated:
+                # read1() does not notice the end of a body of known length;
+                # this does, and so lets conn take another request.
+                response.read()
+        except socket.timeout:
+            conn.close()
+            if expires is not None and time.monotonic() >= expires:
+                raise DeadlineExceeded('deadline exceeded')
+            raise
+        except:
+            conn.close()
+            raise
+
+        if response.will_close or body.truncated:
+            conn.close()
+        else:
+            with self.lock:
+                pooled = self._checkin(key, conn)
+            if not pooled:
+                conn.close()
+        return (body.data(), Response(url, response.status, response.reason, response.msg, body.truncated))
+
+
+class AsyncFetcher(BaseFetcher):
+    """Fetch URLs with a small HTTP/1.1 client on top of asyncio streams.
+
+    The timeout applies to each network operation, not to the request as a
+    whole, just like a socket timeout would.  Use a deadline for that.
+
+    Unlike BlockingFetcher, this always connects to hosts directly; it does
+    not go through proxies.
+    """
+    async def _timed(self, aw):
+        return await asyncio.wait_for(aw, self.timeout)
+
+    async def _connect(self, key):
+        (scheme, host, port) = key
+        if scheme == 'https':
+            (sslcontext, server_hostname) = (self.sslcontext, host)
+        else:
+            (sslcontext, server_hostname) = (None, None)
+
+        if self.resolver.cached(host):
+            addresses = self.resolver.lookup(host)
+        else:
+            addresses = await asyncio.get_running_loop().run_in_executor(None, self.resolver.lookup, host)
+        error = None
+        for (_, addr) in addresses:
+            try:
+                return await self._timed(asyncio.open_connection(addr, port, ssl=sslcontext, server_hostname=server_hostname))
+            except OSError as e:
+                error = e
+        raise error
+
+    async def _send(self, conn, method, selector, headers):
+        (reader, writer) = conn
+        lines = ['%s %s HTTP/1.1'%(method, selector)]
+        lines += ['%s: %s'%(k, value) for k, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1'))
+        await self._timed(writer.drain())
+        return await self._read_head(reader)
+
+    async def _request(self, url, request_headers, method, max_bytes, sink, expires):
+        try:
+            return await asyncio.wait_for(self._exchange(url, request_headers, method, max_bytes, sink),
+                                          self._remaining(expires))
+        except asyncio.TimeoutError:
+            if expires is not None and time.monotonic() >= expires:
+                raise DeadlineExceeded('deadline exceeded')
+            raise
+
+    async def _exchange(self, url, request_headers, method, max_bytes, sink):
+        (key, selector, headers) = self._prepare(url, request_headers)
+        conn = self._checkout(key)
+        while conn is not None and conn[0].at_eof():
+            conn[1].close()
+            conn = self._checkout(key)
+        reused = conn is not None
+        if not reused:
+            conn = await self._connect(key)
+
+        try:
+            try:
+                (version, status, reason, response_headers) = await self._send(conn, method, selector, headers)
+            except (ConnectionResetError, BrokenPipeError):
+                # The server closed an idle keep-alive connection on us.
+                if not reused: raise
+                conn[1].close()
+                conn = await self._connect(key)
+                (version, status, reason, response_headers) = await self._send(conn, method, selector, headers)
+            body = self._body(status, max_bytes, sink)
+            if method == 'HEAD':
+                keepalive = self._keepalive(version, response_headers)
+            else:
+                keepalive = await self._read_body(conn[0], version, response_headers, status, body)
+        except:
+            conn[1].close()
+            raise
+
+        if not keepalive or not self._checkin(key, conn):
+            conn[1].close()
+        return (body.data(), Response(url, status, reason, response_headers, body.truncated))
+
+    async def _read_head(self, reader):
+        first = True
+        while True:
+            line = await self._timed(reader.readline())
+            if first and not line:
+                raise http.client.RemoteDisconnected("Remote end closed connection without response")
+            first = False
+            statusline = line.decode('iso-8859-1').rstrip('\r\n')
+            try:
+                (version, status, reason) = (statusline.split(None, 2) + [''])[:3]
+                if not version.startswith('HTTP/'):
+                    raise ValueError
+                status = int(status)
+            except ValueError:
+                raise http.client.BadStatusLine(statusline)
+
+            headerlines = []
+            while True:
+                line = await self._timed(reader.readline())
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                headerlines.append(line)
+                if len(headerlines) > MAX_HEADERS:
+                    raise http.client.HTTPException("got more than %d headers"%(MAX_HEADERS,))
+            # Skip over interim 1xx responses, like http.client does.
+            if status >= 200:
+                break
+        hstring = b''.join(headerlines).decode('iso-8859-1')
+        headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(hstring)
+        return (version, status, reason.strip(), headers)
+
+    @staticmethod
+    def _keepalive(version, headers):
+        connection = [t.strip() for t in headers.get('Connection', '').lower().split(',')]
+        return version == 'HTTP/1.1' and 'close' not in connection
+
+    async def _read_body(self, reader, version, headers, status, body):
+        """Read the response body into body.
+
+        Returns whether the connection can be used for another request.
+        """
+        keepalive = self._keepalive(version, headers)
+
+        if status in (204, 304):
+            return keepalive
+
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            while True:
+                line = await self._timed(reader.readline())
+                try:
+                    size = int(line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise http.client.IncompleteRead(body.data())
+                if size == 0:
+                    break
+                await self._read_into(reader, body, size)
+                if body.truncated:
+                    return False
+                await self._timed(reader.readline())
+            # discard trailers
+            while (await self._timed(reader.readline())) not in (b'\r\n', b'\n', b''):
+                pass
+            return keepalive
+
+        length = headers.get('Content-Length')
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                length = None
+        if length is not None:
+            await self._read_into(reader, body, length)
+            return keepalive and not body.truncated
+
+        # No framing; the body ends when the server closes the connection.
+        await self._read_into(reader, body)
+        return False
+
+    async def _read_into(self, reader, body, length=None):
+        """Pass the next length bytes from reader to body, or everything up
+           to EOF if length is None.  Stops once body is truncated.
+        """
+        while length is None or length > 0:
+            size = body.next_read_size()
+            if length is not None:
+                size = min(size, length)
+            chunk = await self._timed(reader.read(size))
+            if not chunk:
+                if length is None:
+                    return
+                raise http.client.IncompleteRead(body.data(), length)
+            body.add(chunk)
+            if body.truncated:
+                return
+            if length is not None:
+                length -= len(chunk)
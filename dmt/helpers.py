@@ -1,8 +1,10 @@
 #!/usr/bin/python3
 
+import bisect
 import urllib
 import psycopg2.extras
 import errno
+import hashlib
 import json
 import os
 import re
@@ -60,67 +62,249 @@ def get_tracedir(site):
     tracedir = urllib.parse.urljoin(baseurl, 'project/trace/')
     return tracedir
 
+def get_trace_digest(full):
+    """The key of a tracefile's contents in the traceblob table
+    """
+    return hashlib.sha256(full.encode('utf-8')).hexdigest()
+
 def get_ftpmaster_trace(cur):
     """Get the most current trace file timestamp from ftpmaster
     """
     assert(isinstance(cur, psycopg2.extras.RealDictCursor))
     cur.execute("""
         SELECT trace_timestamp
-        FROM mastertrace JOIN
-            site ON site.id = mastertrace.site_id JOIN
-            checkrun ON checkrun.id = mastertrace.checkrun_id
-        WHERE
-            site.name = %(site_name)s AND
-            trace_timestamp IS NOT NULL
+        FROM ftpmastertrace
         ORDER BY
-            timestamp DESC
+            last_seen DESC
         LIMIT 1
-        """, {
-            'site_name': FTPMASTER,
-        })
+        """)
     res = cur.fetchone()
     if res is None: return None
     return res['trace_timestamp']
 
 def get_latest_checkrun(cur):
-    """Get the most current checkrun
+    """Get the most current checkrun that is completed
     """
     assert(isinstance(cur, psycopg2.extras.RealDictCursor))
     cur.execute("""
         SELECT id, timestamp
         FROM checkrun
+        WHERE completed
         ORDER BY timestamp DESC
         LIMIT 1
         """)
     checkrun = cur.fetchone()
     return checkrun
 
+class MastertracesLastseen:
+    """For trace timestamps from ftp-master, when they were last seen there.
+
+    Held as two parallel lists sorted by trace timestamp, so a lookup is a
+    bisection, and the whole thing pickles small for the renderers.
+    """
+    def __init__(self, rows):
+        """rows are (trace timestamp, last seen) sorted by trace timestamp
+        """
+        self.trace_timestamps = []
+        self.last_seen = []
+        for (trace_timestamp, last_seen) in rows:
+            self.trace_timestamps.append(trace_timestamp)
+            self.last_seen.append(last_seen)
+
+    def get(self, trace_timestamp, default=None):
+        if trace_timestamp is None:
+            return default
+        i = bisect.bisect_left(self.trace_timestamps, trace_timestamp)
+        if i < len(self.trace_timestamps) and self.trace_timestamps[i] == trace_timestamp:
+            return self.last_seen[i]
+        return default
+
+    def __contains__(self, trace_timestamp):
+        return self.get(trace_timestamp) is not None
+
+    def __len__(self):
+        return len(self.trace_timestamps)
+
 def get_ftpmaster_traces_lastseen(cur):
-    """For each trace timestamp from ftp-master, report when it was last seen on ftp-master
+    """For each trace timestamp from ftpmaster, report when it was last seen on ftpmaster
     """
     assert(isinstance(cur, psycopg2.extras.RealDictCursor))
     cur.execute("""
         SELECT
-            checkrun.timestamp,
-            mastertrace.trace_timestamp
-        FROM checkrun JOIN
-            mastertrace ON mastertrace.checkrun_id = checkrun.id JOIN
+            trace_timestamp,
+            last_seen
+        FROM ftpmastertrace
+        ORDER BY
+            trace_timestamp
+        """)
+    return MastertracesLastseen((row['trace_timestamp'], row['last_seen']) for row in cur.fetchall())
+
+def record_ftpmaster_traces(cur, checkrun_id, checkrun_timestamp):
+    """Note in ftpmastertrace the trace ftpmaster had in checkrun_id, once its results are stored
+    """
+    cur.execute("""
+        INSERT INTO ftpmastertrace (trace_timestamp, first_seen, last_seen)
+        SELECT
+            mastertrace.trace_timestamp,
+            %(checkrun_timestamp)s,
+            %(checkrun_timestamp)s
+        FROM mastertrace JOIN
             site ON mastertrace.site_id = site.id
         WHERE
             site.name = %(ftpmastername)s AND
+            mastertrace.last_checkrun_id = %(checkrun_id)s AND
             mastertrace.trace_timestamp IS NOT NULL
-        ORDER BY
-            timestamp
+        ON CONFLICT (trace_timestamp) DO UPDATE SET
+            first_seen = LEAST(ftpmastertrace.first_seen, EXCLUDED.first_seen),
+            last_seen = GREATEST(ftpmastertrace.last_seen, EXCLUDED.last_seen)
         """, {
+            'checkrun_id': checkrun_id,
+            'checkrun_timestamp': checkrun_timestamp,
             'ftpmastername': FTPMASTER,
         })
-    trace_timestamp_lastseen = {}
-    for row in cur.fetchall():
-        trace_timestamp_lastseen[row['trace_timestamp']] = row['timestamp']
-    return trace_timestamp_lastseen
+
+class RunSnapshot:
+    """What the pages of a run share, read from the database once.
+
+    checkrun is the latest completed checkrun, ftpmastertrace the latest trace
+    timestamp from ftpmaster, sites the sites by name, each with its
+    traceset in the oldest checkrun we have, and traceset_elem_ctr how many
+    of those tracesets each trace is in.
+    """
+    def __init__(self, dbh):
+        cur = dbh.cursor()
+        self.checkrun = get_latest_checkrun(cur)
+        self.ftpmastertrace = get_ftpmaster_trace(cur)
+
+        cur.execute("""
+            SELECT
+                site.id,
+                site.name,
+                site.http_override_host,
+                site.http_override_port,
+                site.http_path,
+
+                traceset.traceset::jsonb AS traceset_traceset
+            FROM site LEFT JOIN
+                (
+                 SELECT *
+                   FROM traceset_run
+                   WHERE checkrun_id = (SELECT id FROM checkrun ORDER BY checkrun.timestamp LIMIT 1)
+                ) AS traceset ON site.id = traceset.site_id
+            """)
+        self.sites = {}
+        self.traceset_elem_ctr = {}
+        for row in cur.fetchall():
+            self.sites[row['name']] = row
+            if row['traceset_traceset'] is not None:
+                if not isinstance(row['traceset_traceset'], list):
+                    raise Exception("Hmm.  traceset_traceset for site %s(%s) is not a list"%(row['id'], row['name']))
+                for traceset_elem in row['traceset_traceset']:
+                    self.traceset_elem_ctr[traceset_elem] = self.traceset_elem_ctr.get(traceset_elem, 0) + 1
+        self.sitenames = list(self.sites.keys())
+        cur.close()
+        # nothing to hold on to; a renderer forked later might not use dbh at all
+        dbh.rollback()
+
+_run_snapshot = None
+
+def get_run_snapshot(dbh):
+    """The RunSnapshot of this run, loaded from dbh by the first caller.
+
+    Taken before forking, it is inherited copy-on-write by the children,
+    so pages read it from there instead of each querying it again, and
+    all agree on which checkrun is the latest.
+    """
+    global _run_snapshot
+    if _run_snapshot is None:
+        _run_snapshot = RunSnapshot(dbh)
+    return _run_snapshot
 
 def hostname_comparator(hostname):
     return '.'.join(reversed(hostname.split('.')))
 
 def get_bugs_for_mirror(hostname):
     yield from BTSInfo.bugs_for_mirror(hostname)
+
+def write_file(path, content):
+    """Write content, str or bytes, to path, unless the file has that content already.
+
+    The new contents go to a temporary file next to path that is then
+    renamed over it, so readers never see a partly written file.  An
+    unchanged file keeps its mtime.  Returns whether the file was written.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, 'rb') as f:
+                if f.read() == content:
+                    return False
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    tmp = os.path.join(os.path.dirname(path), '.%s.%d.tmp'%(os.path.basename(path), os.getpid()))
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return True
+
+def get_fingerprint(*inputs):
+    """A digest of inputs, things json can represent, datetimes and the like
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class Manifest:
+    """The fingerprints of the inputs of the pages in a directory, as they were last rendered.
+
+    A page whose inputs have the same fingerprint as last time need not be
+    rendered again.
+    """
+    FILENAME = '.manifest.json'
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.FILENAME)
+        self.directory = directory
+        self.fingerprints = {}
+        try:
+            with open(self.path) as f:
+                self.fingerprints = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            # a broken manifest just means everything gets rendered
+            pass
+
+    def unchanged(self, name, fingerprint):
+        """Whether page name exists, and was rendered from inputs with fingerprint
+        """
+        return self.fingerprints.get(name) == fingerprint and os.path.exists(os.path.join(self.directory, name))
+
+    def update(self, fingerprints):
+        """Record fingerprints, a dict of page name to fingerprint, of pages just rendered.
+
+        Pages that are gone are dropped from the manifest.
+        """
+        self.fingerprints.update(fingerprints)
+        self.fingerprints = {name: fingerprint for (name, fingerprint) in self.fingerprints.items()
+                             if os.path.exists(os.path.join(self.directory, name))}
+        write_file(self.path, json.dumps(self.fingerprints, sort_keys=True, indent=0))
+
+def record_rendered(rendered):
+    """Record in the manifests of their directories the fingerprints of pages that have been rendered.
+
+    rendered are (page file, fingerprint).  A page only gets into the
+    manifest once it is written, so one whose rendering failed is rendered
+    again next time.
+    """
+    by_directory = {}
+    for (outfile, fingerprint) in rendered:
+        by_directory.setdefault(os.path.dirname(outfile), {})[os.path.basename(outfile)] = fingerprint
+    for (directory, fingerprints) in by_directory.items():
+        Manifest(directory).update(fingerprints)
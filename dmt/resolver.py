@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import collections
+from multiprocessing.pool import ThreadPool
+import socket
+import sys
+import threading
+import time
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.resolver
+    __package__ = 'dmt.resolver'
+
+# The system resolver does not tell us the TTL of what it found, so
+# we keep answers for a fixed time, and failures for a shorter one.
+TTL = 300
+NEGATIVE_TTL = 60
+MAX_ENTRIES = 4096
+MAX_RESOLVERS = 64
+
+class ResolveError(OSError):
+    """Looking up a hostname failed.
+    """
+    def __init__(self, hostname, reason):
+        super().__init__('DNS lookup of %s failed: %s'%(hostname, reason))
+        self.hostname = hostname
+        self.reason = reason
+
+class Resolver:
+    """Resolve hostnames through the system resolver, caching the results.
+
+    lookup() returns the cached addresses of a hostname, resolving it first
+    if they are missing or too old.  resolve_all() resolves many hostnames
+    in parallel, so that a checkrun can look up all of its hosts before
+    the checks start and no check has to wait for DNS.
+    """
+    def __init__(self, ttl=TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # hostname -> (expiry time, list of (family, address), or a ResolveError)
+        self.cache = collections.OrderedDict()
+
+    def _get(self, hostname):
+        with self.lock:
+            entry = self.cache.get(hostname)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def _put(self, hostname, result, ttl):
+        with self.lock:
+            self.cache.pop(hostname, None)
+            self.cache[hostname] = (time.monotonic() + ttl, result)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    def _resolve(self, hostname):
+        try:
+            infos = socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            result = ResolveError(hostname, e.strerror)
+            self._put(hostname, result, self.negative_ttl)
+            return result
+        addresses = []
+        for (family, _, _, _, sockaddr) in infos:
+            if (family, sockaddr[0]) not in addresses:
+                addresses.append((family, sockaddr[0]))
+        self._put(hostname, addresses, self.ttl)
+        return addresses
+
+    def cached(self, hostname):
+        """Whether we have a current answer for hostname.
+        """
+        return self._get(hostname) is not None
+
+    def lookup(self, hostname):
+        """Return the addresses of hostname as a list of (family, address).
+
+        Raises ResolveError if it cannot be resolved.
+        """
+        result = self._get(hostname)
+        if result is None:
+            result = self._resolve(hostname)
+        if isinstance(result, ResolveError):
+            raise result
+        return result
+
+    def resolve_all(self, hostnames):
+        """Resolve all of hostnames that are not cached yet, in parallel.
+        """
+        todo = sorted(set(h for h in hostnames if not self.cached(h)))
+        if len(todo) == 0:
+            return
+        pool = ThreadPool(processes=min(MAX_RESOLVERS, len(todo)))
+        try:
+            pool.map(self._resolve, todo)
+        finally:
+            pool.terminate()
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+import collections
+import psycopg2.extras
+import sqlalchemy.dialects.postgresql
+from sqlalchemy.dialects.postgresql import JSONB
+import sys
+import time
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.resultwriter
+    __package__ = 'dmt.resultwriter'
+
+import dmt.db as db
+import dmt.helpers as helpers
+
+# write out buffered results once we have this many,
+BATCH_SIZE = 1000
+# or once the oldest of them has waited this many seconds
+FLUSH_INTERVAL = 30
+
+class ResultWriter:
+    """Write check results to the database in batches.
+
+    Results are buffered per table and written with multi-row INSERTs, and
+    every write is committed, so memory use stays flat however large the
+    checkrun, and what has been written survives if run-tests dies.
+
+    A result that is the same as the one from previous_checkrun_id only
+    extends that row's last_checkrun_id to checkrun_id (see db.INTERVAL_TABLES).
+    """
+    def __init__(self, session, checkrun_id, checkrun_timestamp, previous_checkrun_id=None, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.session = session
+        self.checkrun_id = checkrun_id
+        self.checkrun_timestamp = checkrun_timestamp
+        self.previous_checkrun_id = previous_checkrun_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = collections.OrderedDict()
+        self.blobs = {}
+        self.num_pending = 0
+        self.first_pending = None
+
+    def add(self, check):
+        """Buffer the result of check, a checks.BaseCheck that has run.
+        """
+        self.pending.setdefault(check.MODEL, []).append(check.result)
+        self.blobs.update(check.blobs())
+        self.num_pending += 1
+        if self.first_pending is None:
+            self.first_pending = time.monotonic()
+        if self.num_pending >= self.batch_size or time.monotonic() - self.first_pending >= self.flush_interval:
+            self.flush()
+
+    @staticmethod
+    def _value(column, result):
+        v = result.get(column.name)
+        if v is not None and isinstance(column.type, JSONB):
+            v = psycopg2.extras.Json(v)
+        return v
+
+    @staticmethod
+    def _columns(model, results):
+        """The columns of model that hold results, besides checkrun_id, checkrun_timestamp and last_checkrun_id.
+        """
+        columns = [c for c in model.__table__.columns if not c.primary_key and c.name not in ('checkrun_id', 'last_checkrun_id')]
+        for r in results:
+            unknown = set(r.keys()) - set(c.name for c in columns) - set(('checkrun_id',))
+            assert len(unknown) == 0, "unknown columns %s for %s"%(unknown, model.__tablename__)
+        return columns
+
+    def _extend(self, cur, model, results):
+        """Extend the rows from the previous checkrun that equal one of results.
+
+        Returns the indices of the results that were handled that way.
+        """
+        columns = self._columns(model, results)
+        dialect = sqlalchemy.dialects.postgresql.dialect()
+        template = '(%s)' % (', '.join(['%s::integer'] + ['%%s::%s'%(c.type.compile(dialect=dialect),) for c in columns]),)
+        conditions = ['span."%(c)s" = v."%(c)s"'%{'c': c.name} if not c.nullable else
+                      'span."%(c)s" IS NOT DISTINCT FROM v."%(c)s"'%{'c': c.name}
+                      for c in columns]
+        rows = [tuple([n] + [self._value(c, r) for c in columns]) for (n, r) in enumerate(results)]
+        extended = psycopg2.extras.execute_values(cur, """
+            UPDATE %(table)s AS span
+            SET last_checkrun_id = %(checkrun_id)d
+            FROM (VALUES %%s) AS v (n, %(columns)s)
+            WHERE
+                span.last_checkrun_id = %(previous_checkrun_id)d AND
+                %(conditions)s
+            RETURNING v.n
+            """ % {
+                'table': model.__tablename__,
+                'checkrun_id': self.checkrun_id,
+                'previous_checkrun_id': self.previous_checkrun_id,
+                'columns': ', '.join('"%s"'%(c.name,) for c in columns),
+                'conditions': ' AND\n                '.join(conditions),
+            }, rows, template=template, page_size=len(rows), fetch=True)
+        return set(row[0] for row in extended)
+
+    def _insert(self, cur, model, results):
+        columns = self._columns(model, results)
+        rows = [tuple([r['checkrun_id'], self.checkrun_timestamp, self.checkrun_id] + [self._value(c, r) for c in columns]) for r in results]
+        psycopg2.extras.execute_values(cur,
+            'INSERT INTO %s (checkrun_id, checkrun_timestamp, last_checkrun_id, %s) VALUES %%s'%(model.__tablename__, ', '.join('"%s"'%(c.name,) for c in columns)),
+            rows, page_size=len(rows))
+
+    def flush(self):
+        """Write all buffered results and commit.
+        """
+        if self.num_pending > 0:
+            # use the session's connection, so this is one transaction with whatever the session did
+            cur = self.session.connection().connection.cursor()
+            if len(self.blobs) > 0:
+                # most will be there already: the same master trace is on every mirror
+                psycopg2.extras.execute_values(cur,
+                    'INSERT INTO traceblob (digest, "full") VALUES %s ON CONFLICT DO NOTHING',
+                    sorted(self.blobs.items()), page_size=len(self.blobs))
+            for model, results in self.pending.items():
+                if self.previous_checkrun_id is not None:
+                    extended = self._extend(cur, model, results)
+                    results = [r for (n, r) in enumerate(results) if n not in extended]
+                if len(results) > 0:
+                    self._insert(cur, model, results)
+            if db.Mastertrace in self.pending:
+                helpers.record_ftpmaster_traces(cur, self.checkrun_id, self.checkrun_timestamp)
+            cur.close()
+        self.session.commit()
+        self.pending.clear()
+        self.blobs.clear()
+        self.num_pending = 0
+        self.first_pending = None
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+import collections
+import datetime
+import sqlalchemy
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.scheduler
+    __package__ = 'dmt.scheduler'
+
+import dmt.helpers as helpers
+
+# In adaptive mode, check a mirror this many times per update it does,
+# so we still catch every update and its age stays accurate.
+ADAPTIVE_CHECKS_PER_UPDATE = 4
+# but never leave a mirror unchecked for longer than this
+ADAPTIVE_MAX_INTERVAL = datetime.timedelta(hours=6)
+# slack for the checkrun interval not being exact
+ADAPTIVE_SLACK = datetime.timedelta(minutes=5)
+# mirrors with a score below this are checked every time, as are
+# mirrors with errors within the last ADAPTIVE_ERROR_HOURS
+ADAPTIVE_MIN_SCORE = 50.0
+ADAPTIVE_ERROR_HOURS = 24
+
+class HostScheduler:
+    """Decide which check to run next.
+
+    Checks are queued per destination host (as returned by their host_key()).
+    Hosts take turns, and no host gets more than max_per_host checks in
+    flight at the same time, so a single mirror's checks cannot hog the
+    workers while other mirrors wait.  At most max_in_flight checks are
+    handed out overall.
+
+    The scheduler does no locking of its own.
+    """
+    def __init__(self, checklist, max_per_host, max_in_flight):
+        assert max_per_host >= 1
+        assert max_in_flight >= 1
+        self.max_per_host = max_per_host
+        self.max_in_flight = max_in_flight
+
+        self.queues = collections.OrderedDict()
+        for c in checklist:
+            self.queues.setdefault(c.host_key(), collections.deque()).append(c)
+        self.queued = len(checklist)
+        self.in_flight = collections.Counter()
+        self.total_in_flight = 0
+        # hosts that have queued checks and room for another one in flight, in turn order
+        self.ready = collections.deque(self.queues.keys())
+
+    @property
+    def exhausted(self):
+        """All checks have been handed out.
+        """
+        return self.queued == 0
+
+    def next(self):
+        """Return the next check to run, or None if nothing may be started right now.
+        """
+        if self.total_in_flight >= self.max_in_flight or len(self.ready) == 0:
+            return None
+
+        host = self.ready.popleft()
+        queue = self.queues[host]
+        c = queue.popleft()
+        self.queued -= 1
+        self.in_flight[host] += 1
+        self.total_in_flight += 1
+        if len(queue) > 0 and self.in_flight[host] < self.max_per_host:
+            self.ready.append(host)
+        return c
+
+    def done(self, c):
+        """Record that check c, previously returned by next(), has finished.
+        """
+        host = c.host_key()
+        self.in_flight[host] -= 1
+        self.total_in_flight -= 1
+        # if the host was at its limit it was not ready; now it is again
+        if len(self.queues[host]) > 0 and self.in_flight[host] == self.max_per_host - 1:
+            self.ready.append(host)
+
+
+def _adaptive_interval(row):
+    """How long we may go without checking the site in row, or None if
+       it should be checked every time.
+    """
+    if row.name == helpers.FTPMASTER:
+        return None
+    if row.checkoverview_error is not None or row.recent_errors is not None:
+        return None
+    if row.checkoverview_score is None or row.checkoverview_score < ADAPTIVE_MIN_SCORE:
+        return None
+    if not row.runs_per_day:
+        return None
+    interval = datetime.timedelta(days=1) / float(row.runs_per_day) / ADAPTIVE_CHECKS_PER_UPDATE
+    return min(interval, ADAPTIVE_MAX_INTERVAL)
+
+def get_due_sites(session):
+    """Return the ids of the sites that are due for checking in an adaptive checkrun.
+
+    How often a site needs checking depends on how often its site tracefile
+    changed in the last two weeks, the same runs_per_day the status page
+    shows.  Sites that are new, had errors recently, or have a low score
+    are always due, as is ftp-master.
+    """
+    res = session.execute(sqlalchemy.text("""
+        SELECT
+            site.id,
+            site.name,
+            CURRENT_TIMESTAMP - last_checked.timestamp AS since_checked,
+
+            runs_per_day.runs_per_day,
+
+            latest.error AS checkoverview_error,
+            latest.score AS checkoverview_score,
+
+            recent_errors.errors AS recent_errors
+
+        FROM site LEFT OUTER JOIN
+            (
+             SELECT mastertrace.site_id,
+                    MAX(checkrun.timestamp) AS timestamp
+             FROM mastertrace JOIN
+                  checkrun ON mastertrace.last_checkrun_id = checkrun.id
+             GROUP BY mastertrace.site_id
+            ) AS last_checked ON site.id = last_checked.site_id LEFT OUTER JOIN
+            (
+             SELECT num_runs / days AS runs_per_day,
+                    site_id
+             FROM (
+              SELECT COUNT(distinct trace_timestamp) AS num_runs,
+                     EXTRACT(epoch from CURRENT_TIMESTAMP - MIN(checkrun.timestamp))/24/3600 AS days,
+                     sitetrace.site_id
+              FROM sitetrace_run AS sitetrace JOIN
+                   checkrun ON sitetrace.checkrun_id = checkrun.id
+              WHERE sitetrace.trace_timestamp IS NOT NULL AND
+                    sitetrace.checkrun_timestamp > CURRENT_TIMESTAMP - INTERVAL '2 week' AND
+                    checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '2 week'
+              GROUP BY sitetrace.site_id) AS sub
+            ) AS runs_per_day ON site.id = runs_per_day.site_id LEFT OUTER JOIN
+            (
+             SELECT DISTINCT ON (checkoverview.site_id)
+                    checkoverview.site_id,
+                    checkoverview.error,
+                    checkoverview.score
+             FROM checkoverview JOIN
+                  checkrun ON checkoverview.checkrun_id = checkrun.id
+             ORDER BY checkoverview.site_id, checkrun.timestamp DESC
+            ) AS latest ON site.id = latest.site_id LEFT OUTER JOIN
+            (
+             SELECT checkoverview.site_id,
+                    COUNT(*) AS errors
+             FROM checkoverview JOIN
+                  checkrun ON checkoverview.checkrun_id = checkrun.id
+             WHERE checkoverview.error IS NOT NULL AND
+                   checkoverview.checkrun_timestamp > CURRENT_TIMESTAMP - INTERVAL '%(error_hours)d hours' AND
+                   checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '%(error_hours)d hours'
+             GROUP BY checkoverview.site_id
+            ) AS recent_errors ON site.id = recent_errors.site_id
+        """ % {
+            'error_hours': ADAPTIVE_ERROR_HOURS,
+        }))
+
+    due = set()
+    for row in res:
+        interval = _adaptive_interval(row)
+        if interval is None or row.since_checked is None or row.since_checked + ADAPTIVE_SLACK >= interval:
+            due.add(row.id)
+    return due
@@ -1,4 +1,10 @@
 $(function() {
+  // from last-run.js, as of the latest generate run, which a page not
+  // rendered again since does not know
+  if (typeof last_run !== 'undefined') {
+    $('#last-run').text(last_run);
+  }
+
   $.tablesorter.addParser({
     id: 'hostname',
     is: function (s) {
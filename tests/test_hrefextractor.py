@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+"""Check that TracesetFetcher.list_tracefiles, which streams listings
+through checks.HrefExtractor, finds the same tracefiles as the
+BeautifulSoup code it replaced.
+
+The listings are in listings/<name>.html, and what the BeautifulSoup code
+made of them in listings/<name>.json.  Running this file with --record
+rewrites the latter; that needs bs4.
+"""
+
+import json
+import os
+import random
+import sys
+import types
+import unittest
+
+if __package__ is None or __package__ == '':
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+
+import dmt.checks as checks
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+LISTINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'listings')
+SITE = types.SimpleNamespace(id=1, name='deb.example.org', http_override_host=None, http_override_port=None, http_path='/debian/')
+
+def get_listings():
+    return sorted(name[:-len('.html')] for name in os.listdir(LISTINGS) if name.endswith('.html'))
+
+def read_listing(name):
+    with open(os.path.join(LISTINGS, name + '.html'), 'rb') as f:
+        return f.read()
+
+def read_recorded(name):
+    with open(os.path.join(LISTINGS, name + '.json')) as f:
+        return json.load(f)
+
+def beautifulsoup_tracefiles(data, tracedir):
+    """What list_tracefiles found before HrefExtractor, from the whole listing.
+    """
+    soup = BeautifulSoup(data, "html.parser")
+    links = soup.find_all('a')
+    links = filter(lambda x: 'href' in x.attrs, links)
+    links = map(lambda x: checks.TracesetFetcher._clean_link(x.get('href'), tracedir), links)
+    tracefiles = filter(lambda x: x is not None, links)
+    tracefiles = checks.TracesetFetcher._filter_tracefilenames(tracefiles)
+    return sorted(set(tracefiles))
+
+class ChunkFetcher:
+    """Hand a listing to the sink in chunks of the given sizes, as a fetcher would.
+    """
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+
+    async def fetch(self, url, request_headers=None, max_bytes=None, sink=None, deadline=None):
+        pos = 0
+        sizes = iter(self.sizes)
+        while pos < len(self.data):
+            n = next(sizes, len(self.data))
+            sink(self.data[pos:pos+n])
+            pos += n
+        return (None, types.SimpleNamespace(truncated=False))
+
+def list_tracefiles(data, sizes=()):
+    check = checks.TracesetFetcher(SITE, 1)
+    check.fetcher = ChunkFetcher(data, sizes)
+    return checks.run_sync(check.list_tracefiles())
+
+class HrefExtractorTest(unittest.TestCase):
+    def test_recorded(self):
+        for name in get_listings():
+            with self.subTest(listing=name):
+                self.assertEqual(list_tracefiles(read_listing(name)), read_recorded(name))
+
+    def test_chunked(self):
+        rnd = random.Random(0)
+        for name in get_listings():
+            data = read_listing(name)
+            expected = read_recorded(name)
+            for _ in range(20):
+                sizes = [rnd.randint(1, 64) for _ in range(len(data))]
+                with self.subTest(listing=name, sizes=sizes[:8]):
+                    self.assertEqual(list_tracefiles(data, sizes), expected)
+            with self.subTest(listing=name, sizes='bytewise'):
+                self.assertEqual(list_tracefiles(data, [1]*len(data)), expected)
+
+    @unittest.skipIf(BeautifulSoup is None, "needs bs4")
+    def test_beautifulsoup(self):
+        tracedir = checks.helpers.get_tracedir(SITE.__dict__)
+        for name in get_listings():
+            with self.subTest(listing=name):
+                self.assertEqual(beautifulsoup_tracefiles(read_listing(name), tracedir), read_recorded(name))
+
+def record():
+    tracedir = checks.helpers.get_tracedir(SITE.__dict__)
+    for name in get_listings():
+        with open(os.path.join(LISTINGS, name + '.json'), 'w') as f:
+            json.dump(beautifulsoup_tracefiles(read_listing(name), tracedir), f, indent=1)
+            f.write('\n')
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--record']:
+        record()
+    else:
+        unittest.main()
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+"""Check that RunProcessor's bulk mode, which processes the rows of all
+sites in one itertools.groupby loop, gives the same checkoverview rows
+as processing every site with its own MirrorProcessor.
+
+Both run against FakeDB, which answers their queries from the same
+made-up checkruns instead of from PostgreSQL.
+"""
+
+import copy
+import datetime
+import sys
+import unittest
+import unittest.mock
+
+if __package__ is None or __package__ == '':
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+
+import dmt.RunProcessor as RunProcessor
+
+def ts(hour):
+    return datetime.datetime(2026, 10, 18, tzinfo=datetime.timezone.utc) + datetime.timedelta(hours=hour)
+
+# master trace timestamp -> when ftp-master last had it
+MASTERTRACES_LASTSEEN = {
+    ts(0): ts(6),
+    ts(6): ts(12),
+    ts(12): ts(30),
+}
+
+def checkrun(checkrun_id, hour, master=None, site=None, master_error=None, site_error=None, skipped=False):
+    return {
+        'checkrun_id': checkrun_id,
+        'checkrun_timestamp': ts(hour),
+        'mastertrace_id': None if master is None and master_error is None else 100 + checkrun_id,
+        'mastertrace_error': master_error,
+        'mastertrace_trace_timestamp': master,
+        'sitetrace_id': None if site is None and site_error is None else 200 + checkrun_id,
+        'sitetrace_error': site_error,
+        'sitetrace_trace_timestamp': site,
+        'siteskip_id': 300 + checkrun_id if skipped else None,
+    }
+
+def alias(name, checkrun_id, master=None, error=None, stored=True):
+    return {
+        'sitealias_name': name,
+        'sitealiasmastertrace_id': 400 + checkrun_id if stored else None,
+        'sitealiasmastertrace_error': error,
+        'sitealiasmastertrace_trace_timestamp': master,
+    }
+
+class FakeDB:
+    """The database as far as RunProcessor sees it.
+
+    versions is sitetraceversion as a dict, new[site_id] the rows of the
+    checkruns that have not been processed, prev[site_id] the last
+    checkoverview row of the site, and aliases[(site_id, checkrun_id)] the
+    results of the site's aliases.
+    """
+    def __init__(self, versions, new, prev, aliases):
+        self.versions = versions
+        self.new = new
+        self.prev = prev
+        self.aliases = aliases
+        self.inserted = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.result = None
+
+    def execute(self, query, params=None):
+        db = self.db
+        if 'INSERT INTO checkoverview' in query:
+            db.inserted.append(dict(params))
+            self.result = None
+        elif 'FROM site CROSS JOIN' in query:
+            self.result = [dict(row, site_id=site_id) for site_id in sorted(db.new) for row in db.new[site_id]]
+        elif 'checkrun.id NOT in' in query:
+            self.result = db.new.get(params['site_id'], [])
+        elif 'DISTINCT ON (site_id)' in query:
+            self.result = [dict(db.prev[site_id], site_id=site_id) for site_id in params['site_ids'] if db.prev.get(site_id) is not None]
+        elif 'checkoverview.aliases' in query:
+            prev = db.prev.get(params['site_id'])
+            self.result = [] if prev is None else [prev]
+        elif 'FROM sitetraceversion' in query:
+            keys = zip(params['site_ids'], params['sitetrace_trace_timestamps'])
+            self.result = [{'site_id': site_id, 'sitetrace_trace_timestamp': sitetrace_trace_timestamp, 'mastertrace_trace_timestamp': db.versions[(site_id, sitetrace_trace_timestamp)]}
+                           for (site_id, sitetrace_trace_timestamp) in keys if (site_id, sitetrace_trace_timestamp) in db.versions]
+        elif 'FROM sitealias JOIN' in query:
+            self.result = [dict(row, site_id=site_id, checkrun_id=checkrun_id)
+                           for ((site_id, checkrun_id), rows) in sorted(db.aliases.items())
+                           if site_id in params['site_ids'] and checkrun_id in params['checkrun_ids']
+                           for row in rows]
+        elif 'FROM sitealias LEFT OUTER JOIN' in query:
+            self.result = db.aliases.get((params['site_id'], params['checkrun_id']), [])
+        else:
+            raise AssertionError('unexpected query: ' + query)
+        # like psycopg2, hand out rows the caller may change
+        self.result = copy.deepcopy(self.result)
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if len(self.result) > 0 else None
+
+def execute_values(cur, query, argslist, template=None, page_size=100):
+    if 'INSERT INTO sitetraceversion' in query:
+        # ON CONFLICT DO NOTHING
+        for (site_id, sitetrace_trace_timestamp, mastertrace_trace_timestamp) in argslist:
+            cur.db.versions.setdefault((site_id, sitetrace_trace_timestamp), mastertrace_trace_timestamp)
+    else:
+        assert 'INSERT INTO checkoverview' in query
+        cur.db.inserted.extend(dict(args) for args in argslist)
+
+def make_db():
+    return FakeDB(
+        versions = {
+            (1, ts(0)): ts(0),
+        },
+        new = {
+            1: [
+                checkrun(10, 6, skipped=True),
+                checkrun(11, 7, master=ts(6), site=ts(0)),
+                checkrun(12, 8, skipped=True),
+                checkrun(13, 9, master=ts(6), site=ts(6)),
+                checkrun(14, 10, master=ts(6), site_error='404 not found'),
+                checkrun(15, 11),
+                checkrun(16, 12, skipped=True),
+                checkrun(17, 13, master=ts(9), site=ts(9)),
+                checkrun(18, 14, skipped=True),
+            ],
+            2: [
+                checkrun(12, 8, skipped=True, master=ts(6), site=ts(6)),
+                checkrun(13, 9, master=ts(6), site=ts(12)),
+                checkrun(14, 10, master_error='timed out', site=ts(6)),
+                checkrun(17, 13, master=ts(12), site=ts(12)),
+            ],
+            3: [],
+        },
+        prev = {
+            1: {'error': None, 'version': ts(0), 'aliases': {'a.example.org': {'ok': True}}},
+            2: None,
+        },
+        aliases = {
+            (1, 11): [alias('a.example.org', 11, master=ts(6)), alias('b.example.org', 11, master=ts(0))],
+            (1, 13): [alias('a.example.org', 13, error='connection refused'), alias('b.example.org', 13, stored=False)],
+            (2, 13): [alias('c.example.org', 13, master=ts(6))],
+        },
+    )
+
+class ProcessorTest(unittest.TestCase):
+    def process_per_site(self):
+        db = make_db()
+        with unittest.mock.patch.object(RunProcessor.psycopg2.extras, 'execute_values', execute_values):
+            for site_id in sorted(db.new):
+                RunProcessor.MirrorProcessor(site={'id': site_id}, mastertraces_lastseen=MASTERTRACES_LASTSEEN).process(db)
+        return db.inserted
+
+    def process_bulk(self):
+        db = make_db()
+        with unittest.mock.patch.object(RunProcessor.psycopg2.extras, 'execute_values', execute_values):
+            RunProcessor.BulkProcessor(mastertraces_lastseen=MASTERTRACES_LASTSEEN).process(db)
+        return db.inserted
+
+    def test_same_rows(self):
+        per_site = self.process_per_site()
+        self.assertEqual(len(per_site), 13)
+        self.assertEqual(self.process_bulk(), per_site)
+
+    def test_rows(self):
+        results = {(data['site_id'], data['checkrun_id']): data for data in self.process_per_site()}
+        # skipped: the last result carried forward, aged as of this checkrun
+        self.assertEqual((results[(1, 10)]['version'], results[(1, 10)]['age']), (ts(0), datetime.timedelta(0)))
+        self.assertEqual(results[(1, 10)]['aliases'], '{"a.example.org":{"ok":true}}')
+        self.assertEqual((results[(1, 12)]['version'], results[(1, 12)]['age']), (ts(0), datetime.timedelta(hours=2)))
+        self.assertEqual(results[(1, 12)]['aliases'], '{"a.example.org":{"ok":true},"b.example.org":{"ok":true}}')
+        self.assertEqual(results[(1, 13)]['aliases'], '{"a.example.org":{"error":"connection refused","ok":false}}')
+        self.assertEqual(results[(1, 14)]['error'], 'sitetrace: 404 not found')
+        self.assertEqual(results[(1, 15)]['error'], 'mastertrace unavailable; sitetrace unavailable')
+        # ... and so is an error
+        self.assertEqual(results[(1, 16)]['error'], 'mastertrace unavailable; sitetrace unavailable')
+        self.assertEqual(results[(1, 17)]['error'], 'unexpected mirror version: ' + str(ts(9)))
+        # nothing to carry forward from yet
+        self.assertEqual((results[(2, 12)]['version'], results[(2, 12)]['age']), (ts(6), datetime.timedelta(0)))
+        self.assertEqual(results[(2, 14)]['error'], 'mastertrace: timed out')
+        # the version is the master trace of when the site trace first showed up
+        self.assertEqual((results[(2, 17)]['version'], results[(2, 17)]['age']), (ts(6), datetime.timedelta(hours=1)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+"""Check that scheduler.HostScheduler takes hosts in turn, keeps to its
+limits, and hands out every check exactly once.
+"""
+
+import sys
+import unittest
+
+if __package__ is None or __package__ == '':
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+
+import dmt.scheduler as scheduler
+
+class Check:
+    def __init__(self, host, n):
+        self.host = host
+        self.n = n
+
+    def host_key(self):
+        return self.host
+
+    def __repr__(self):
+        return '%s/%d' % (self.host, self.n)
+
+def make_checklist(counts):
+    return [Check(host, n) for host, count in counts for n in range(count)]
+
+def take_all(sched):
+    """Call next() until it gives nothing, returning what it gave.
+    """
+    started = []
+    while True:
+        c = sched.next()
+        if c is None:
+            return started
+        started.append(c)
+
+class HostSchedulerTest(unittest.TestCase):
+    def test_round_robin(self):
+        checklist = make_checklist([('a', 3), ('b', 3), ('c', 1)])
+        sched = scheduler.HostScheduler(checklist, max_per_host=1, max_in_flight=10)
+        started = take_all(sched)
+        self.assertEqual([c.host for c in started], ['a', 'b', 'c'])
+
+    def test_max_per_host(self):
+        checklist = make_checklist([('a', 5), ('b', 1)])
+        sched = scheduler.HostScheduler(checklist, max_per_host=2, max_in_flight=10)
+        started = take_all(sched)
+        self.assertEqual(sorted(c.host for c in started), ['a', 'a', 'b'])
+        # finishing one of a's checks makes room for exactly one more
+        sched.done(started[0])
+        more = take_all(sched)
+        self.assertEqual([c.host for c in more], ['a'])
+
+    def test_max_in_flight(self):
+        checklist = make_checklist([('a', 2), ('b', 2), ('c', 2)])
+        sched = scheduler.HostScheduler(checklist, max_per_host=2, max_in_flight=3)
+        started = take_all(sched)
+        self.assertEqual(len(started), 3)
+        sched.done(started[0])
+        self.assertEqual(len(take_all(sched)), 1)
+
+    def test_drain(self):
+        counts = [('a', 7), ('b', 1), ('c', 4)]
+        checklist = make_checklist(counts)
+        for max_per_host in (1, 2, 3):
+            with self.subTest(max_per_host=max_per_host):
+                sched = scheduler.HostScheduler(checklist, max_per_host=max_per_host, max_in_flight=4)
+                running = take_all(sched)
+                handed_out = list(running)
+                while running:
+                    for host in sched.in_flight:
+                        self.assertLessEqual(sched.in_flight[host], max_per_host)
+                    sched.done(running.pop(0))
+                    more = take_all(sched)
+                    handed_out.extend(more)
+                    running.extend(more)
+                self.assertTrue(sched.exhausted)
+                self.assertEqual(sched.total_in_flight, 0)
+                self.assertCountEqual(handed_out, checklist)
+
+    def test_reject_limits_below_one(self):
+        checklist = make_checklist([('a', 1)])
+        for max_per_host in (0, -1):
+            with self.subTest(max_per_host=max_per_host):
+                with self.assertRaises(AssertionError):
+                    scheduler.HostScheduler(checklist, max_per_host=max_per_host, max_in_flight=10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+"""Check that RunScorer's default ScoringPolicy gives the scores the
+if/elif chain it replaced gave, and that ScoreSimulator.History.replay
+scores a history the way RunScorer.Scorer does.
+"""
+
+import datetime
+import io
+import sys
+import unittest
+import unittest.mock
+
+if __package__ is None or __package__ == '':
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+
+import dmt.RunScorer as RunScorer
+import dmt.ScoreSimulator as ScoreSimulator
+
+def adjust(score, delta, ignore_this_run, error, age):
+    """RunScorer's scoring before the policies, as it was.
+    """
+    weight = float(delta)/(3600*24)
+
+    if ignore_this_run:
+        adj = 0
+    elif error is not None:
+        adj = -30
+    elif age <= datetime.timedelta(hours = 4):
+        adj = +5
+    elif age <= datetime.timedelta(hours = 12):
+        adj = +1
+    elif age <= datetime.timedelta(hours = 24):
+        adj = 0
+    elif age <= datetime.timedelta(hours = 48):
+        adj = -5
+    else:
+        adj = -30
+
+    score += float(adj) * weight
+    if   score >  100: score = 100
+    elif score < -100: score = -100
+    return score
+
+AGES = [datetime.timedelta(hours=hours, seconds=seconds) for hours in (0, 4, 12, 24, 48, 96) for seconds in (-1, 0, 1) if hours > 0 or seconds >= 0]
+
+class PolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = RunScorer.POLICIES['default']
+
+    def test_adjustments(self):
+        for score in (-100.0, -42.5, 0.0, 17.25, 99.9, 100.0):
+            for delta in (60, 300, 3600, 86400):
+                for ignore_this_run in (False, True):
+                    for error in (None, 'timed out'):
+                        for age in AGES:
+                            with self.subTest(score=score, delta=delta, ignore_this_run=ignore_this_run, error=error, age=age):
+                                self.assertEqual(self.policy.score(score, delta, ignore_this_run, error, age),
+                                                 adjust(score, delta, ignore_this_run, error, age))
+
+    def test_clamping(self):
+        # ten days' worth of a day's adjustment
+        self.assertEqual(self.policy.score(90.0, 864000, False, None, datetime.timedelta(hours=1)), 100)
+        self.assertEqual(self.policy.score(-90.0, 864000, False, 'timed out', None), -100)
+
+    def test_first_checkrun(self):
+        # the scorer used to start from 0 with an arbitrary 300 seconds
+        for error in (None, 'timed out'):
+            for age in AGES:
+                with self.subTest(error=error, age=age):
+                    self.assertEqual(self.policy.score(None, None, False, error, age), adjust(0.0, 300, False, error, age))
+
+def ts(minutes):
+    return datetime.datetime(2026, 10, 18, tzinfo=datetime.timezone.utc) + datetime.timedelta(minutes=minutes)
+
+def make_rows():
+    """Checkoverview rows of a few sites over a few checkruns, none scored yet.
+
+    Checkrun 3 is mostly errors, so the scorer ignores it; site 4 only
+    shows up in checkrun 2.
+    """
+    errors = {
+        (3, 1): 'timed out', (3, 2): 'connection refused', (3, 3): 'timed out',
+        (4, 2): '404 not found',
+    }
+    checkruns = [(1, ts(0)), (2, ts(20)), (3, ts(45)), (4, ts(180)), (5, ts(185))]
+    rows = []
+    for (checkrun_id, checkrun_timestamp) in checkruns:
+        for site_id in (1, 2, 3, 4):
+            if site_id == 4 and checkrun_id < 2:
+                continue
+            error = errors.get((checkrun_id, site_id))
+            rows.append({
+                'id': len(rows) + 1,
+                'site_id': site_id,
+                'checkrun_id': checkrun_id,
+                'checkrun_timestamp': checkrun_timestamp,
+                'error': error,
+                'age': None if error is not None else datetime.timedelta(hours=3*site_id + checkrun_id),
+                'score': None,
+            })
+    return rows
+
+class FakeDB:
+    """checkoverview, as far as Scorer reads it, from make_rows()
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.result = None
+
+    def execute(self, query, params=None):
+        rows = self.db.rows
+        if 'GROUP BY' in query:
+            self.result = []
+            for (checkrun_id, checkrun_timestamp) in sorted(set((row['checkrun_id'], row['checkrun_timestamp']) for row in rows), key=lambda k: k[1]):
+                run = [row for row in rows if row['checkrun_id'] == checkrun_id]
+                self.result.append({
+                    'checkrun_id': checkrun_id,
+                    'checkrun_timestamp': checkrun_timestamp,
+                    'total': len(run),
+                    'errors': sum(1 for row in run if row['error'] is not None),
+                })
+        elif 'DISTINCT ON (site_id)' in query:
+            self.result = []
+        elif 'ORDER BY' in query:
+            self.result = [dict(row) for row in sorted(rows, key=lambda row: (row['checkrun_timestamp'], row['site_id']))]
+        else:
+            raise AssertionError('unexpected query: ' + query)
+
+    def fetchall(self):
+        return self.result
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        pass
+
+def write_history(rows):
+    """rows as export_history would have written them
+    """
+    f = io.StringIO()
+    f.write(','.join(ScoreSimulator.HISTORY_COLUMNS) + '\n')
+    for row in sorted(rows, key=lambda row: (row['checkrun_timestamp'], row['site_id'])):
+        f.write('%d,%d,%d,%s,%s\n'%(
+            row['checkrun_id'],
+            row['checkrun_timestamp'].timestamp(),
+            row['site_id'],
+            row['error'] if row['error'] is not None else '',
+            int(row['age'].total_seconds()) if row['age'] is not None else ''))
+    f.seek(0)
+    return f
+
+class ReplayTest(unittest.TestCase):
+    def test_same_scores(self):
+        rows = make_rows()
+        written = []
+        def execute_values(cur, query, argslist, template=None, page_size=100):
+            written.extend(argslist)
+        with unittest.mock.patch.object(RunScorer.psycopg2.extras, 'execute_values', execute_values):
+            RunScorer.Scorer().process(FakeDB(rows))
+        self.assertEqual(len(written), len(rows))
+
+        history = ScoreSimulator.History(write_history(rows))
+        self.assertEqual([ignore_this_run for (_, ignore_this_run, _) in history.batches], [False, False, True, False, False])
+        replayed = [score for batch_scores in history.replay(RunScorer.POLICIES['default']) for score in batch_scores]
+        self.assertEqual(replayed, [score for (_, _, score) in written])
+
+if __name__ == '__main__':
+    unittest.main()